@@ -12,6 +12,9 @@ from tqdm import tqdm
 import scipy
 from scipy.interpolate import interp1d
 
+from flyvr.video import open_video, raw_segment_path
+from flyvr.store import read_stream
+
 #####################
 ###  Import Data  ###
 #####################
@@ -23,12 +26,35 @@ Path = '/Users/lukebrezovec/FlyTracker/Data/exp-20171031-214433'
 
 class Trial:
     def __init__ (self, dirName):
-        self.cam = Cam(os.path.join(dirName, 'cam.txt'))
-        self.cnc = Cnc(os.path.join(dirName, 'cnc.txt'))
+        # binary logs, or text logs for older trials
+        if os.path.isfile(os.path.join(dirName, 'cam.bin')):
+            self.cam = Cam(os.path.join(dirName, 'cam.bin'))
+            self.cnc = Cnc(os.path.join(dirName, 'cnc.bin'))
+        else:
+            self.cam = Cam(os.path.join(dirName, 'cam.txt'))
+            self.cnc = Cnc(os.path.join(dirName, 'cnc.txt'))
+
+        # full-trial video, recorded as MJPEG stream, in a container, or raw
+        # (in segment files cam_raw-000.raw, cam_raw-001.raw, ...)
+        self.video = None
+        for name in ['cam_compr.mjpeg', 'cam_compr.mkv', 'cam_raw.raw']:
+            fname = os.path.join(dirName, name)
+            if os.path.isfile(fname) or os.path.isfile(raw_segment_path(fname, 0)):
+                self.video = open_video(fname)
+                break
 
 class Cam:
     def __init__ (self, fname):
         print(fname)
+        if fname.endswith('.bin'):
+            # only frames with a fly are logged
+            cam = read_stream(fname)
+            self.tvec = cam['t']
+            self.xvec = cam['x']
+            self.yvec = cam['y']
+            self.pvec = np.ones(len(self.tvec), dtype=bool)
+            self.avec = cam['angle']
+            return
         self.tvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(0,))
         self.xvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(2,))
         self.yvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(3,))
@@ -38,6 +64,12 @@ class Cam:
 class Cnc:
     def __init__ (self, fname):
         print(fname)
+        if fname.endswith('.bin'):
+            cnc = read_stream(fname)
+            self.tvec = cnc['t']
+            self.xvec = cnc['x']
+            self.yvec = cnc['y']
+            return
         self.tvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(0,))
         self.xvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(1,))
         self.yvec = np.genfromtxt(fname, delimiter=',',skip_header=1,usecols=(2,))
@@ -1,14 +1,16 @@
 import sys
 import numpy as np
 
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout
 from PyQt5 import uic
 from functools import partial
 from PyQt5.QtGui import QPixmap
 from PyQt5 import QtGui
 
 from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
-from PyQt5.QtCore import QDir, Qt, QUrl
+from PyQt5.QtCore import QDir, Qt, QUrl, QTimer
+
+from flyvr.video import open_video
 
 def main():
     def valuechg(ui, data):
@@ -25,11 +27,16 @@ def main():
 
     videofile = '/Users/lukebrezovec/FlyTracker/Data/trial-4-20180919-182832/cam_compr.mkv'
     #videofile = '/Users/lukebrezovec/FlyTracker/Data/exp-20180111-185730-leg-video-2x/trial-1-20180111-185824-8ms/converted_quicktime_s.mov'
-    ui.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
-    ui.play_button.clicked.connect(lambda x: play_movie(ui))
+    if videofile.endswith('.mjpeg'):
+        # raw MJPEG streams are not understood by QMediaPlayer
+        ui.video_view = VideoFileView(videofile)
+        ui.play_button.clicked.connect(lambda x: ui.video_view.toggle())
+    else:
+        ui.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
+        ui.play_button.clicked.connect(lambda x: play_movie(ui))
 
-    ui.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(videofile)))
-    ui.mediaPlayer.setVideoOutput(ui.video_window)
+        ui.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(videofile)))
+        ui.mediaPlayer.setVideoOutput(ui.video_window)
     ui.play_button.setEnabled(True)
 
     file = '/Volumes/groups/trc/data/Brezovec/VR Arena/exp-20181104-162518/raw_gate_data.txt'
@@ -62,6 +69,42 @@ def play_movie(ui):
     else:
         ui.mediaPlayer.play()
 
+class VideoFileView(QWidget):
+    # plays back a recorded trial video (grayscale or color) frame by frame
+    def __init__(self, videofile, fps=30):
+        super().__init__()
+        self.video = open_video(videofile)
+        self.index = 0
+
+        self.setWindowTitle('Trial Video')
+        self.image_label = QLabel()
+        self.main_layout = QVBoxLayout()
+        self.main_layout.addWidget(self.image_label)
+        self.setLayout(self.main_layout)
+        self.show()
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.update_window)
+        self.fps = fps
+
+    def toggle(self):
+        if self.timer.isActive():
+            self.timer.stop()
+        else:
+            self.timer.start(int(1/self.fps*1000))
+
+    def update_window(self):
+        if self.index >= len(self.video):
+            self.timer.stop()
+            return
+
+        img = self.video.read(self.index)
+        self.index += 1
+
+        height, width = img.shape
+        q_img = QtGui.QImage(img.data, width, height, width, QtGui.QImage.Format_Grayscale8)
+        self.image_label.setPixmap(QPixmap.fromImage(q_img))
+
 if __name__ == '__main__':
     main()
 
@@ -96,9 +96,9 @@ class TrialThread(Service):
         _trial_dir = os.path.join(self.exp_dir, folder)
         os.makedirs(_trial_dir)
 
-        self.cnc.startLogging(os.path.join(_trial_dir, 'cnc.txt'))
-        self.cam.startLogging(os.path.join(_trial_dir, 'cam.txt'),os.path.join(_trial_dir, 'cam_compr.mkv'))
-        self.opto.startLogging(os.path.join(_trial_dir, 'opto.txt'))
+        self.cnc.startLogging(os.path.join(_trial_dir, 'cnc.bin'))
+        self.cam.startLogging(os.path.join(_trial_dir, 'cam.bin'),os.path.join(_trial_dir, self.cam.video_name))
+        self.opto.startLogging(os.path.join(_trial_dir, 'opto.bin'))
 
         self._trial_dir = _trial_dir
         self.mrstim.nextStim(self._trial_dir)
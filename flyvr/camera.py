@@ -3,22 +3,57 @@ import copy
 import numpy as np
 import sys
 
-from pypylon import pylon
 from math import pi, sqrt, hypot
-from time import time
+from time import time, sleep
 from threading import Lock
-import numpy as np
 
 from flyvr.service import Service
+from flyvr.pipeline import PipelineStage, FramePool
+from flyvr.video import MjpegWriter, RawWriter, index_path
+from flyvr.source import PylonSource
+from flyvr.pose import PoseBus
+from flyvr.store import STREAMS, to_float, to_int
+from flyvr import logwriter
+from flyvr import trace
 
 from vrcam.train_angle import AnglePredictor
 from vrcam.finder import FlyFinder
 from vrcam.image import bound_point
 
 class CamThread(Service):
-    def __init__(self, defaultThresh=150, maxTime=12e-3, bufX=200, bufY=200):
+    def __init__(self, defaultThresh=150, maxTime=12e-3, bufX=200, bufY=200, source=None, grab_mode='mono8',
+                 roi_search=True, pipelined=True, detect_depth=1, annotate_depth=2, encode_depth=8,
+                 record_mode='mkv', encode_workers=4, gray_video=True, raw_segment_size=1<<30):
+        # Run grab / detect / annotate / encode as separate stages
+        self.pipelined = pipelined
+
+        # Video recording format: 'mkv' (the default) uses a single
+        # cv2.VideoWriter and gives a file any player can open, 'mjpeg'
+        # compresses frames on a pool of encoder workers into a bare JPEG
+        # stream that only flyvr.video (and ffmpeg) can read, and 'raw'
+        # copies the 8-bit frames losslessly into memory-mapped segment files
+        # of about raw_segment_size bytes
+        if record_mode not in ['mjpeg', 'mkv', 'raw']:
+            raise Exception('Invalid record mode.')
+        self.record_mode = record_mode
+        self.encode_workers = encode_workers
+        self.encode_pending = 2*encode_workers
+        self.raw_segment_size = raw_segment_size
+
+        # Record the single-channel grayscale frame rather than expanding it to BGR
+        # (raw recordings are always grayscale)
+        self.gray_video = gray_video or record_mode == 'raw'
+
+        # Size the frame pool so that every queue slot, every stage in progress,
+        # the published frames and the frame being grabbed can hold a buffer
+        # (including the frames the parallel encoder is still compressing, of
+        # which it queues at most encode_pending before dropping frames)
+        num_buffers = detect_depth + annotate_depth + encode_depth + 7 if pipelined else 3
+        if pipelined and record_mode == 'mjpeg':
+            num_buffers += self.encode_pending
+
         # Serial I/O interface to CNC
-        self.cam = Camera()
+        self.cam = Camera(source=source, grab_mode=grab_mode, num_buffers=num_buffers, roi_search=roi_search)
 
         # Lock for communicating fly pose changes
         self.flyDataLock = Lock()
@@ -45,12 +80,44 @@ class CamThread(Service):
         self.logFull = None
         self.logState = False
 
+        # Lock for the video writer, separate from logLock so that writing a
+        # frame never holds up the detect stage
+        self.videoLock = Lock()
+
+        # Frame index of the video, and rows written to the pose log so far
+        self.videoIndex = None
+        self.videoFrames = 0
+        self.poseRows = 0
+
         self.show_threshold = False
         self.draw_contours = True
 
         self.flyPresent = False
         self.fly = None
 
+        # Pose snapshots for other services
+        self.poseBus = PoseBus()
+
+        # Running frame latency statistics
+        self.latencyCount = 0
+        self.latencySum = 0
+        self.latencyMax = 0
+        self.lastLatency = None
+
+        # Pipeline stages, connected by bounded ring buffers.  Each queued
+        # item holds a reference to a buffer in the frame pool.
+        self.framePool = FramePool(num_buffers)
+        self.frameInfos = [None]*num_buffers
+        self.drawIndex = None
+        self.saveIndex = None
+        self.detectStage = PipelineStage('detect', self.detectBody, capacity=detect_depth,
+                                         on_drop=self.framePool.release)
+        self.annotateStage = PipelineStage('annotate', self.annotateBody, capacity=annotate_depth,
+                                           on_drop=lambda item: self.framePool.release(item[0]))
+        self.encodeStage = PipelineStage('encode', self.encodeBody, capacity=encode_depth,
+                                         on_drop=lambda item: self.framePool.release(item[0]))
+        self.stages = [self.detectStage, self.annotateStage, self.encodeStage]
+
         # call constructor from parent        
         super().__init__(maxTime=maxTime)
 
@@ -64,51 +131,224 @@ class CamThread(Service):
         with self.saveFrameLock:
             self._saveFrame = value
 
+    def setup(self):
+        # The stages are started from the loop thread once its scheduling
+        # profile is in effect, so that their threads (and the MJPEG encoder
+        # threads, which the encode stage creates) inherit it.
+        if self.pipelined:
+            for stage in self.stages:
+                stage.schedReport = self.schedReport
+                stage.start()
+
+    def stop(self):
+        super().stop()
+        if self.pipelined:
+            for stage in self.stages:
+                stage.stop()
+
     # overriding method from parent...
     def loopBody(self):
-        
-        # read and process frame
-        self.fly, self.saveFrame, self.drawFrame = self.cam.processNext()
-
-        if self.fly is None:
-            self.flyPresent = False
+        if self.pipelined:
+            self.grabBody()
+        else:
+            self.serialBody()
+
+    def grabBody(self):
+        # grab stage: capture into a free pooled buffer and hand it to detection
+        if not self.cam.source.is_grabbing():
+            self.stopGrabbing()
+            return
+
+        index = self.framePool.acquire()
+        if index is None:
+            # every buffer is still held downstream; let the stages catch up
+            with self.waiting():
+                sleep(1e-3)
+            return
+
+        try:
+            info = self.cam.grabNext(self.cam.grayBufs[index])
+        except:
+            self.framePool.release(index)
+            raise
+
+        # the source ran out of frames (e.g. the end of a video)
+        if info is None:
+            self.framePool.release(index)
+            self.stopGrabbing()
+            return
+
+        self.frameInfos[index] = info
+        self.detectStage.put(index)
+
+    def detectBody(self, index):
+        # detect stage: locate the fly and publish the pose right away
+        try:
+            fly = self.cam.detect(self.cam.grayBufs[index])
+            info = self.frameInfos[index]
+            self.publishPose(fly, info)
+            self.updateLatency(info)
+
+            # write pose log
+            with self.logLock:
+                logState = self.logState
+                poseRow = -1
+                if logState and fly is not None:
+                    poseRow = self.logPose(fly, info)
+
+            # hand the frame off to the stages that are not on the critical path
+            self.framePool.retain(index)
+            self.annotateStage.put((index, fly))
+            if logState:
+                self.framePool.retain(index)
+                self.encodeStage.put((index, poseRow))
+        finally:
+            self.framePool.release(index)
+
+    def annotateBody(self, item):
+        # annotate stage: draw the overlay for the GUI
+        index, fly = item
+        drawFrame = self.cam.drawBufs[index]
+        self.cam.annotate(self.cam.grayBufs[index], fly, drawFrame)
+
+        # publish the frame, keeping its buffer alive until the next one replaces it
+        prevIndex, self.drawIndex = self.drawIndex, index
+        self.drawFrame = drawFrame
+        if prevIndex is not None:
+            self.framePool.release(prevIndex)
+
+    def encodeBody(self, item):
+        # encode stage: write the compressed video, expanding to BGR if needed
+        index, poseRow = item
+        if self.gray_video:
+            saveFrame = self.cam.grayBufs[index]
         else:
-            self.flyPresent = True
+            saveFrame = self.cam.saveBufs[index]
+            cv2.cvtColor(self.cam.grayBufs[index], cv2.COLOR_GRAY2BGR, dst=saveFrame)
 
-        #fly.center is x, y tuple
+        prevIndex, self.saveIndex = self.saveIndex, index
+        self.saveFrame = saveFrame
+        if prevIndex is not None:
+            self.framePool.release(prevIndex)
 
-        # update fly data variable
-        #self.flyData = flyData
+        with self.videoLock:
+            if self.logFull is not None:
+                if self.record_mode == 'mjpeg':
+                    # the encoder holds on to the buffer until it is compressed
+                    self.framePool.retain(index)
+                    self.writeVideo(saveFrame, self.frameInfos[index], poseRow,
+                                    done=lambda: self.framePool.release(index))
+                else:
+                    self.writeVideo(saveFrame, self.frameInfos[index], poseRow)
+
+    def serialBody(self):
+        # read and process frame
+        fly, self.saveFrame, self.drawFrame = self.cam.processNext(gray=self.gray_video)
+
+        # nothing new if the source has stopped grabbing
+        if self.saveFrame is None:
+            self.stopGrabbing()
+            return
 
-        # update the debugging frame variable
-        #self.frameData = frameData
+        info = self.cam.frameInfo
+        self.publishPose(fly, info)
+        self.updateLatency(info)
 
         # write logs
         with self.logLock:
-            if self.logState:
-                if self.fly is not None:
-                    logStr = (str(time()) + ',' +
-                              str(self.fly.centerX) + ',' +
-                              str(self.fly.centerY) + ',' +
-                              str(self.fly.angle) + '\n')
-                    self.logFile.write(logStr)
+            poseRow = -1
+            if self.logState and self.fly is not None:
+                poseRow = self.logPose(self.fly, info)
+
+        with self.videoLock:
+            if self.logFull is not None:
                 if self.saveFrame is not None and self.saveFrame.shape != 0:
-                    self.logFull.write(self.saveFrame)
-
-        # # Process frame if desired
-        # if frameData is not None:
-        #     if self.show_threshold:
-        #         outFrame = cv2.cvtColor(frameData.threshFrame, cv2.COLOR_GRAY2BGR)
-        #     else:
-        #         outFrame = frameData.inFrame
-        #
-        #     # draw the fly contour if status available
-        #     if frameData.flyContour is not None:
-        #         if self.draw_contours:
-        #             cv2.drawContours(outFrame, [frameData.flyContour], 0, (0, 255, 0), 2)
-        #
-        #     # locking assign
-        #     self.outFrame = outFrame
+                    if self.record_mode == 'mjpeg':
+                        # the camera reuses its buffers, so the encoder needs a copy
+                        self.writeVideo(self.saveFrame.copy(), info, poseRow)
+                    else:
+                        self.writeVideo(self.saveFrame, info, poseRow)
+
+    def stopGrabbing(self):
+        # end the loop from inside, so that cleanup() still closes the camera;
+        # stop() then only has to join the thread and the stages
+        print('Camera source stopped grabbing.')
+        self.done.set()
+
+    def publishPose(self, fly, info):
+        if fly is not None:
+            self.poseBus.publish(info.frame_id, info.cam_time, info.host_time,
+                                 fly.centerX, fly.centerY, fly.angle, True)
+        else:
+            self.poseBus.publish(info.frame_id, info.cam_time, info.host_time,
+                                 None, None, None, False)
+
+        self.fly = fly
+        self.flyPresent = fly is not None
+
+        trace.record(info.frame_id, trace.DETECT)
+
+    @property
+    def pose(self):
+        return self.poseBus.read()
+
+    def logPose(self, fly, info):
+        # returns the row number in the pose log, or -1 if the row was dropped
+        if not self.logFile.append(time(), fly.centerX, fly.centerY, to_float(fly.angle),
+                                   fly.search_mode == 'roi', to_int(info.frame_id),
+                                   to_float(info.cam_time), to_float(info.latency), to_int(info.dropped)):
+            return -1
+        self.poseRows += 1
+        return self.poseRows - 1
+
+    def writeVideo(self, frame, info, poseRow, done=None):
+        # add a frame to the trial video and its index (called with videoLock held)
+        meta = (to_int(info.frame_id), to_float(info.cam_time), to_float(info.host_time), poseRow)
+        if self.record_mode == 'mjpeg':
+            # the byte offset is only known once the muxer writes the frame
+            self.logFull.write(frame, done=done, meta=meta)
+        elif self.record_mode == 'raw':
+            # frames are spread over segment files, so there is no single byte offset
+            self.logFull.write(frame, meta=meta)
+            self.videoIndex.append(self.videoFrames, -1, frame.nbytes, *meta)
+            self.videoFrames += 1
+        else:
+            self.logFull.write(frame)
+            self.videoIndex.append(self.videoFrames, -1, -1, *meta)
+            self.videoFrames += 1
+
+    def updateLatency(self, info):
+        # host-side latency from frame arrival to pose publication
+        info.latency = time() - info.host_time
+
+        self.latencyCount += 1
+        self.latencySum += info.latency
+        self.latencyMax = max(self.latencyMax, info.latency)
+        self.lastLatency = info.latency
+
+    def frameStats(self):
+        return {'frames': self.cam.frameCount,
+                'dropped': self.cam.droppedFrames,
+                'latency_last': self.lastLatency,
+                'latency_mean': self.latencySum/self.latencyCount if self.latencyCount > 0 else None,
+                'latency_max': self.latencyMax}
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics['frames'] = self.frameStats()
+        metrics['pipeline'] = self.pipelineStats()
+        return metrics
+
+    def pipelineStats(self):
+        stats = {'grab': {'depth': 0,
+                          'capacity': 0,
+                          'drops': self.framePool.starved,
+                          'processed': getattr(self, 'iterCount', 0)}}
+        for stage in self.stages:
+            stats[stage.name] = stage.stats()
+        # frames the MJPEG writer dropped because its queue was full
+        stats['encode']['writer_drops'] = getattr(self.logFull, 'framesDropped', 0)
+        return stats
 
     @property
     def flyData(self):
@@ -141,49 +381,90 @@ class CamThread(Service):
             self._threshold = val
 
     def startLogging(self, logFile, logFull):
-        with self.logLock:
-            # save log state
-            self.logState = True
-
-            # close previous log file
-            if self.logFile is not None:
-                self.logFile.close()
-
-            # close previous full log video
-            if self.logFull is not None:
-                self.logFull.release()
-
-            # open new log file
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,x,y,angle\n')
-
-            # compressed full video
+        # open new pose log
+        newLogFile = logwriter.open_store(logFile, STREAMS['cam'])
+
+        # frame index of the video, for exact alignment with the pose log
+        videoIndex = logwriter.open_store(index_path(logFull), STREAMS['video'])
+
+        # full video (opened before taking the locks, since preallocating a
+        # raw segment can take a while)
+        if self.record_mode == 'raw':
+            newLogFull = RawWriter(logFull, (self.cam.grab_height, self.cam.grab_width),
+                                   segment_size=self.raw_segment_size)
+        elif self.record_mode == 'mjpeg':
+            newLogFull = MjpegWriter(logFull, num_workers=self.encode_workers,
+                                     max_pending=self.encode_pending,
+                                     on_written=lambda frame, offset, size, meta:
+                                         videoIndex.append(frame, offset, size, *meta))
+        else:
             fourcc_compr = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
 
             # get camera image width/height
             cam_width = self.cam.grab_width
             cam_height = self.cam.grab_height
 
-            self.logFull = cv2.VideoWriter(logFull, fourcc_compr, 124.2, (cam_width, cam_height))
+            newLogFull = cv2.VideoWriter(logFull, fourcc_compr, 124.2, (cam_width, cam_height),
+                                         isColor=not self.gray_video)
+
+        with self.logLock, self.videoLock:
+            # save log state
+            self.logState = True
+
+            prevLogFile, self.logFile = self.logFile, newLogFile
+            self.poseRows = 0
+
+            prevLogFull, self.logFull = self.logFull, newLogFull
+            prevVideoIndex, self.videoIndex = self.videoIndex, videoIndex
+            self.videoFrames = 0
+
+        # close the previous logs, without holding up the pipeline
+        self.closeLogs(prevLogFile, prevLogFull, prevVideoIndex)
+
+    @property
+    def video_name(self):
+        # file name for the full video, depending on the recording format
+        if self.record_mode == 'raw':
+            return 'cam_raw.raw'
+        return 'cam_compr.' + self.record_mode
 
     def stopLogging(self):
-        with self.logLock:
+        # let the encoder finish the frames that are already queued
+        if self.pipelined:
+            self.encodeStage.flush(timeout=1.0)
+
+        with self.logLock, self.videoLock:
             # save log state
             self.logState = False
 
-            # close previous log file
-            if self.logFile is not None:
-                self.logFile.close()
+            logFile, self.logFile = self.logFile, None
+            logFull, self.logFull = self.logFull, None
+            videoIndex, self.videoIndex = self.videoIndex, None
 
-            # close previous full log video
-            if self.logFull is not None:
-                self.logFull.release()
+        # closing the video can take a while (e.g. flushing a raw segment), so
+        # it happens after the detect and encode stages have been let go
+        self.closeLogs(logFile, logFull, videoIndex)
+
+        # make sure the pose log is on disk, also when running in a child process
+        logwriter.flush()
+
+    def closeLogs(self, logFile, logFull, videoIndex):
+        if logFile is not None:
+            logFile.close()
+
+        # the video index is closed once the last frame is in
+        if logFull is not None:
+            logFull.release()
+        if videoIndex is not None:
+            videoIndex.close()
 
     def cleanup(self):
-        self.cam.camera.StopGrabbing()
+        self.cam.close()
 
 class Camera:
-    def __init__(self, px_per_m = 37023.1016957): # calibrated for 2x on 2/6/2018):
+    def __init__(self, px_per_m = 37023.1016957, # calibrated for 2x on 2/6/2018
+                 source=None, grab_mode='mono8', num_buffers=3,
+                 roi_search=True, max_fly_speed=0.1, roi_margin=3e-3):
         # Instaniate fly finder and predictor from vrcam package
         self.angle_predictor = AnglePredictor()
         self.fly_finder = FlyFinder()
@@ -191,21 +472,42 @@ class Camera:
         # Store the number of pixels per meter
         self.px_per_m = px_per_m
 
-        # Open the capture stream
-        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-        self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
-
-        # Grab a dummy frame to get the width and height
-        grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-        self.grab_width = int(grabResult.Width)
-        self.grab_height = int(grabResult.Height)
-        grabResult.Release()
-        print('Camera grab dimensions: ({}, {})'.format(self.grab_width, self.grab_height))
-
-        # Set up image converter
-        self.converter = pylon.ImageFormatConverter()
-        self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
-        self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+        # Region-of-interest search settings.  While the fly is being followed,
+        # only a window around its last position is searched.  The window grows
+        # with the time since the fly was last seen, using the maximum speed of
+        # the fly relative to the camera (m/s), plus a margin (m) for the body.
+        self.roi_search = roi_search
+        self.max_fly_speed = max_fly_speed
+        self.roi_margin = roi_margin
+        self.lastCenter = None
+        self.lastSeen = None
+
+        # Search mode used for the most recent frame ('roi' or 'full')
+        self.search_mode = 'full'
+        self.searchCounts = {'roi': 0, 'full': 0}
+
+        # Open the frame source (the Basler camera unless told otherwise)
+        if source is None:
+            source = PylonSource(grab_mode=grab_mode)
+        self.source = source
+        self.grab_width = source.grab_width
+        self.grab_height = source.grab_height
+
+        # Frame accounting
+        self.frameInfo = None
+        self.prevFrameId = None
+        self.frameCount = 0
+        self.droppedFrames = 0
+
+        # Preallocate the frame buffers.  Frames handed out to other threads
+        # rotate through a small pool so that a reader never sees a buffer
+        # being overwritten by the very next grab.
+        self.num_buffers = num_buffers
+        self.bufIndex = 0
+        shape = (self.grab_height, self.grab_width)
+        self.grayBufs = [np.empty(shape, dtype=np.uint8) for _ in range(num_buffers)]
+        self.saveBufs = [np.empty(shape + (3,), dtype=np.uint8) for _ in range(num_buffers)]
+        self.drawBufs = [np.empty(shape + (3,), dtype=np.uint8) for _ in range(num_buffers)]
 
     def flyCandidate(self, ellipse):
         return ((self.ma_min <= ellipse.ma <= self.ma_max) and
@@ -218,31 +520,81 @@ class Camera:
         tip = bound_point((ax, ay), img)
         cv2.arrowedLine(img, point, tip, color, thickness, tipLength=0.3)
 
-    def processNext(self):
-        if not self.camera.IsGrabbing():
-            return None, None
+    def grabNext(self, grayFrame):
+        # Capture a single frame into the given grayscale buffer
+        info = self.source.grab(grayFrame)
+        if info is None:
+            return None
+
+        # Count frames that never reached us, using the camera frame counter
+        if self.prevFrameId is not None:
+            gap = info.frame_id - self.prevFrameId - 1
+            if gap > 0:
+                self.droppedFrames += gap
+        self.prevFrameId = info.frame_id
+        self.frameCount += 1
+
+        info.dropped = self.droppedFrames
+        self.frameInfo = info
 
-        # Capture a single frame
-        grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-        image = self.converter.Convert(grabResult)
-        inFrame = image.GetArray().copy()
-        grabResult.Release()
+        trace.record(info.frame_id, trace.GRAB, info.host_time)
 
-        # Convert frame to grayscale
-        grayFrame = cv2.cvtColor(inFrame, cv2.COLOR_BGR2GRAY)
+        return info
+
+    def processNext(self, gray=False):
+        if not self.source.is_grabbing():
+            return None, None, None
+
+        # Pick the next set of preallocated buffers
+        self.bufIndex = (self.bufIndex + 1) % self.num_buffers
+        grayFrame = self.grayBufs[self.bufIndex]
+        saveFrame = self.saveBufs[self.bufIndex]
+        drawFrame = self.drawBufs[self.bufIndex]
+
+        # Capture a single grayscale frame
+        if self.grabNext(grayFrame) is None:
+            return None, None, None
 
         # Find fly using vrcam
-        fly = self.fly_finder.locate(grayFrame)
-        saveFrame = cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR)
+        fly = self.detect(grayFrame)
 
-        rows, cols = grayFrame.shape
+        # Only expand to BGR if the saved frame needs to be in color
+        if gray:
+            saveFrame = grayFrame
+        else:
+            cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR, dst=saveFrame)
 
-        drawFrame = saveFrame.copy()
+        # Draw the overlay
+        self.annotate(grayFrame, fly, drawFrame)
 
-        if fly is not None:
+        return fly, saveFrame, drawFrame
 
-            center = fly.center
-            angle = self.angle_predictor.predict(fly.patch)
+    def detect(self, grayFrame):
+        rows, cols = grayFrame.shape
+        thisTime = time()
+
+        # Search around the last known position first
+        fly = None
+        if self.roi_search and self.lastCenter is not None:
+            x0, y0, x1, y1 = self.roiBounds(rows, cols, thisTime - self.lastSeen)
+            if x1 > x0 and y1 > y0:
+                fly = self.fly_finder.locate(grayFrame[y0:y1, x0:x1])
+            if fly is not None:
+                # shift the result back into full-frame coordinates
+                fly.center = (fly.center[0] + x0, fly.center[1] + y0)
+                fly.contour = fly.contour + np.array([x0, y0], dtype=fly.contour.dtype)
+                self.search_mode = 'roi'
+
+        # Fall back to the full frame if the fly was lost
+        if fly is None:
+            fly = self.fly_finder.locate(grayFrame)
+            self.search_mode = 'full'
+
+        self.searchCounts[self.search_mode] += 1
+
+        if fly is not None:
+            self.lastCenter = fly.center
+            self.lastSeen = thisTime
 
             cx = fly.center[0]
             cy = fly.center[1]
@@ -250,15 +602,38 @@ class Camera:
             cy = -(cy - (rows / 2.0)) / self.px_per_m
             fly.centerX = cx
             fly.centerY = cy
-            disp_center = bound_point(center, drawFrame)
-            self.arrow_from_point(drawFrame, disp_center, angle)
-            fly.angle = angle
+            fly.angle = self.angle_predictor.predict(fly.patch)
+            fly.search_mode = self.search_mode
+        else:
+            self.lastCenter = None
+            self.lastSeen = None
+
+        return fly
+
+    def roiBounds(self, rows, cols, dt):
+        # half-width of the search window in pixels
+        half = int(round((self.roi_margin + self.max_fly_speed*dt) * self.px_per_m))
+
+        cx = int(round(self.lastCenter[0]))
+        cy = int(round(self.lastCenter[1]))
+
+        x0 = min(max(cx - half, 0), cols)
+        x1 = min(max(cx + half, 0), cols)
+        y0 = min(max(cy - half, 0), rows)
+        y1 = min(max(cy + half, 0), rows)
+
+        return x0, y0, x1, y1
+
+    def annotate(self, grayFrame, fly, drawFrame):
+        cv2.cvtColor(grayFrame, cv2.COLOR_GRAY2BGR, dst=drawFrame)
+
+        if fly is not None:
+            disp_center = bound_point(fly.center, drawFrame)
+            self.arrow_from_point(drawFrame, disp_center, fly.angle)
 
             #draw contour on frame
             cv2.drawContours(drawFrame, [fly.contour], 0, (0, 255, 0), 2)
 
-        return fly, saveFrame, drawFrame
-
-    def __del__(self):
+    def close(self):
         # When everything done, release the capture handle
-        self.camera.StopGrabbing()
+        self.source.close()
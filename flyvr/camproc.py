@@ -0,0 +1,403 @@
+import multiprocessing as mp
+import numpy as np
+
+from functools import reduce
+from math import isnan
+from multiprocessing import shared_memory
+from threading import Lock
+from time import time
+
+from flyvr.service import Service
+from flyvr.pose import Pose, PoseBus
+from flyvr import trace
+from flyvr import sched
+
+# Hosting the camera pipeline in a separate process keeps the Python work of
+# frame processing from competing for the GIL with the control loop.  The
+# child process runs an ordinary CamThread; the parent sees a CamProcess,
+# which has the CamThread interface used by TrackThread, TrialThread and the
+# GUI.  Poses are passed through a small shared-memory struct, display frames
+# through a shared-memory ring buffer, and everything else (logging,
+# settings, statistics) through commands on a pipe.
+
+POSE_DTYPE = np.dtype([('lock', '<i8'), ('frame_id', '<i8'), ('cam_time', '<f8'),
+                       ('host_time', '<f8'), ('x', '<f8'), ('y', '<f8'), ('angle', '<f8'),
+                       ('present', '<i8')])
+
+def to_float(value):
+    return np.nan if value is None else value
+
+def from_float(value):
+    return None if isnan(value) else float(value)
+
+class SharedPose:
+    # A single pose record protected by a sequence lock: the writer makes
+    # the lock counter odd while it updates the fields, and readers retry
+    # until they have copied the record without the counter changing.
+
+    def __init__(self, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=POSE_DTYPE.itemsize)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.rec = np.ndarray((1,), dtype=POSE_DTYPE, buffer=self.shm.buf)
+        if self.owner:
+            self.rec[0] = (0, -1, np.nan, np.nan, np.nan, np.nan, np.nan, 0)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, frame_id, cam_time, host_time, x, y, angle, present):
+        rec = self.rec
+        rec['lock'] += 1
+        rec['frame_id'] = -1 if frame_id is None else frame_id
+        rec['cam_time'] = to_float(cam_time)
+        rec['host_time'] = to_float(host_time)
+        rec['x'] = to_float(x)
+        rec['y'] = to_float(y)
+        rec['angle'] = to_float(angle)
+        rec['present'] = present
+        rec['lock'] += 1
+
+    def read(self):
+        # returns the number of poses written so far and the latest pose
+        while True:
+            lock = int(self.rec['lock'][0])
+            if lock % 2 == 1:
+                continue
+            rec = self.rec[0].copy()
+            if int(self.rec['lock'][0]) == lock:
+                break
+
+        frame_id = int(rec['frame_id'])
+        return lock//2, Pose(seq=lock//2, frame_id=None if frame_id < 0 else frame_id,
+                             cam_time=from_float(rec['cam_time']),
+                             host_time=from_float(rec['host_time']),
+                             x=from_float(rec['x']), y=from_float(rec['y']),
+                             angle=from_float(rec['angle']), present=bool(rec['present']))
+
+    def close(self):
+        self.rec = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedFrameRing:
+    # Ring of frame slots in shared memory.  Each slot has its own sequence
+    # lock, and a counter records how many frames have been written, so a
+    # reader can always copy out the newest complete frame.
+
+    def __init__(self, shape, slots=3, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        frameBytes = int(np.prod(self.shape))
+        headerBytes = 8*(slots + 1)
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=headerBytes + slots*frameBytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        # header: number of frames written, then one lock per slot
+        self.header = np.ndarray((slots + 1,), dtype='<i8', buffer=self.shm.buf)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=headerBytes)
+        if self.owner:
+            self.header[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    def write(self, frame):
+        count = self.count + 1
+        slot = count % self.slots
+        self.header[slot + 1] += 1
+        np.copyto(self.frames[slot], frame)
+        self.header[slot + 1] += 1
+        self.header[0] = count
+
+    def read(self, out=None):
+        # copy of the newest frame, or None if nothing has been written yet
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            slot = count % self.slots
+            lock = int(self.header[slot + 1])
+            if lock % 2 == 1:
+                continue
+            if out is None:
+                out = self.frames[slot].copy()
+            else:
+                np.copyto(out, self.frames[slot])
+            if int(self.header[slot + 1]) == lock:
+                return out
+
+    def close(self):
+        self.header = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedPoseBus(PoseBus):
+    # PoseBus for the child process that also writes every pose to the
+    # shared struct and wakes up the parent
+    def __init__(self, sharedPose, poseReady):
+        self.sharedPose = sharedPose
+        self.poseReady = poseReady
+        super().__init__()
+
+    def publish(self, frame_id, cam_time, host_time, x, y, angle, present):
+        self.sharedPose.write(frame_id, cam_time, host_time, x, y, angle, present)
+        self.poseReady.release()
+        super().publish(frame_id, cam_time, host_time, x, y, angle, present)
+
+def camera_process(conn, poseReady, kwargs, frameSlots, frameRate, profile):
+    # entry point of the camera process
+    from flyvr.camera import CamThread
+
+    # applied to the main thread first, so every thread created below inherits it
+    schedReport = None
+    if profile is not None:
+        schedReport = sched.apply_profile(profile, 'camera process')
+
+    class SharedCamThread(CamThread):
+        # copies display frames into the shared ring, at most frameRate per second
+        frameRing = None
+        lastFrameTime = 0
+
+        @property
+        def drawFrame(self):
+            return self._drawFrame
+
+        @drawFrame.setter
+        def drawFrame(self, value):
+            self._drawFrame = value
+            if value is not None and self.frameRing is not None:
+                now = time()
+                if now - self.lastFrameTime >= 1/frameRate:
+                    self.lastFrameTime = now
+                    self.frameRing.write(value)
+
+    try:
+        camThread = SharedCamThread(**kwargs)
+        sharedPose = SharedPose()
+        frameRing = SharedFrameRing((camThread.cam.grab_height, camThread.cam.grab_width, 3), frameSlots)
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+
+    camThread.poseBus = SharedPoseBus(sharedPose, poseReady)
+    camThread.frameRing = frameRing
+    conn.send(('ready', sharedPose.name, frameRing.name, frameRing.shape, schedReport))
+
+    started = False
+    try:
+        while True:
+            cmd, args = conn.recv()
+            try:
+                if cmd == 'start':
+                    camThread.start()
+                    started = True
+                    result = None
+                elif cmd == 'stop':
+                    break
+                elif cmd == 'get':
+                    result = reduce(getattr, args[0].split('.'), camThread)
+                elif cmd == 'set':
+                    path, value = args
+                    parts = path.split('.')
+                    setattr(reduce(getattr, parts[:-1], camThread), parts[-1], value)
+                    result = None
+                elif cmd == 'call':
+                    result = getattr(camThread, args[0])(*args[1:])
+                elif cmd == 'metrics':
+                    from flyvr.metrics import snapshot_all
+                    result = snapshot_all()
+                else:
+                    raise Exception('Invalid camera process command.')
+            except Exception as e:
+                conn.send(('error', repr(e)))
+            else:
+                conn.send(('ok', result))
+    finally:
+        if started:
+            camThread.stop()
+        frameRing.close()
+        sharedPose.close()
+        conn.send(('ok', None))
+
+class RemoteAttributes:
+    # attribute access forwarded to an object inside the camera process,
+    # e.g. camProcess.cam.r_min = 0.2
+    def __init__(self, proc, path):
+        object.__setattr__(self, '_proc', proc)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        return self._proc.command('get', self._path + '.' + name)
+
+    def __setattr__(self, name, value):
+        self._proc.command('set', self._path + '.' + name, value)
+
+class CamProcess(Service):
+    def __init__(self, frameSlots=3, frameRate=30, timeout=50e-3, startTimeout=30, camProfile=None,
+                 **kwargs):
+        # kwargs are passed to CamThread in the child process, so any frame
+        # source given must be picklable.  camProfile is the scheduling profile
+        # for the whole camera process (by default the one set for CamThread).
+        if camProfile is None:
+            camProfile = sched.profile_for('CamThread')
+        self.record_mode = kwargs.get('record_mode', 'mkv')
+        self.timeout = timeout
+
+        # the child is spawned rather than forked, since this process has threads
+        ctx = mp.get_context('spawn')
+        self.conn, childConn = ctx.Pipe()
+        self.cmdLock = Lock()
+        self.poseReady = ctx.Semaphore(0)
+        self.process = ctx.Process(target=camera_process, daemon=True,
+                                   args=(childConn, self.poseReady, kwargs, frameSlots, frameRate,
+                                         camProfile))
+        self.process.start()
+
+        # wait for the camera to open
+        if not self.conn.poll(startTimeout):
+            self.process.terminate()
+            raise Exception('Camera process did not start.')
+        reply = self.conn.recv()
+        if reply[0] != 'ready':
+            self.process.join()
+            raise Exception('Camera process failed: {}'.format(reply[1]))
+        _, poseName, frameName, frameShape, self.childSchedReport = reply
+
+        self.sharedPose = SharedPose(poseName)
+        self.frameRing = SharedFrameRing(frameShape, frameSlots, frameName)
+        self.lastSharedSeq = 0
+
+        # poses are republished locally, so TrackThread can wait on them as usual
+        self.poseBus = PoseBus()
+
+        # access to the camera settings, e.g. camProcess.cam.r_min
+        self.cam = RemoteAttributes(self, 'cam')
+
+        # call constructor from parent
+        super().__init__(iter_warn=False)
+
+    def command(self, cmd, *args):
+        with self.cmdLock:
+            self.conn.send((cmd, args))
+            status, result = self.conn.recv()
+        if status != 'ok':
+            raise Exception('Camera process command {} failed: {}'.format(cmd, result))
+        return result
+
+    def start(self):
+        self.command('start')
+        super().start()
+
+    def stop(self):
+        super().stop()
+        self.command('stop')
+        self.process.join()
+
+    # overriding method from parent...
+    def loopBody(self):
+        # relay new poses from the camera process
+        with self.waiting():
+            ready = self.poseReady.acquire(timeout=self.timeout)
+        if not ready:
+            return
+
+        # several poses may have arrived; only the latest one matters
+        while self.poseReady.acquire(block=False):
+            pass
+
+        seq, pose = self.sharedPose.read()
+        if seq > self.lastSharedSeq:
+            self.lastSharedSeq = seq
+            self.poseBus.publish(pose.frame_id, pose.cam_time, pose.host_time,
+                                 pose.x, pose.y, pose.angle, pose.present)
+
+            # the child has its own tracer, so the hops up to here are
+            # recorded on this side: the pose counts as detected once relayed
+            trace.record(pose.frame_id, trace.GRAB, pose.host_time)
+            trace.record(pose.frame_id, trace.DETECT)
+
+    def cleanup(self):
+        self.frameRing.close()
+        self.sharedPose.close()
+
+    @property
+    def pose(self):
+        return self.poseBus.read()
+
+    @property
+    def flyPresent(self):
+        return self.pose.present
+
+    @property
+    def drawFrame(self):
+        return self.frameRing.read()
+
+    @property
+    def flyData(self):
+        return self.command('get', 'flyData')
+
+    @property
+    def threshold(self):
+        return self.command('get', 'threshold')
+
+    @threshold.setter
+    def threshold(self, value):
+        self.command('set', 'threshold', value)
+
+    @property
+    def show_threshold(self):
+        return self.command('get', 'show_threshold')
+
+    @show_threshold.setter
+    def show_threshold(self, value):
+        self.command('set', 'show_threshold', value)
+
+    @property
+    def draw_contours(self):
+        return self.command('get', 'draw_contours')
+
+    @draw_contours.setter
+    def draw_contours(self, value):
+        self.command('set', 'draw_contours', value)
+
+    @property
+    def video_name(self):
+        # same names as CamThread.video_name
+        if self.record_mode == 'raw':
+            return 'cam_raw.raw'
+        return 'cam_compr.' + self.record_mode
+
+    def startLogging(self, logFile, logFull):
+        self.command('call', 'startLogging', logFile, logFull)
+
+    def stopLogging(self):
+        self.command('call', 'stopLogging')
+
+    def frameStats(self):
+        return self.command('call', 'frameStats')
+
+    def pipelineStats(self):
+        return self.command('call', 'pipelineStats')
+
+    def remoteMetrics(self):
+        # service metrics from inside the camera process
+        return self.command('metrics')
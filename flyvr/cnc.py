@@ -1,25 +1,49 @@
-import serial, platform
+import serial, platform, struct
+import numpy as np
 
+from collections import deque
 from math import pi
-from time import sleep, time
-from threading import Lock
+from time import sleep, time, perf_counter
+from threading import Lock, Thread, Condition
 import serial.tools.list_ports
 
 from flyvr.service import Service
 from flyvr.util import serial_number_to_comport
+from flyvr.metrics import LatencyHistogram
+from flyvr.store import STREAMS
+from flyvr import logwriter
+from flyvr import trace
 
 class CncThread(Service):
-    def __init__(self, maxTime=12e-3):
-        # Serial I/O interface to CNC
-        self.cnc = CNC()
+    def __init__(self, maxTime=12e-3, transport='async', device=None):
+        # Serial I/O interface to CNC.  With the 'async' transport, commands
+        # are streamed by a writer thread and status reports are parsed by a
+        # reader thread as they arrive; with 'sync', every iteration sends a
+        # command and blocks until its status comes back.
+        # device can be a flyvr.virtual_cnc.VirtualStepper instead of the gantry.
+        if transport == 'async':
+            self.cnc = AsyncCNC(device=device)
+        elif transport == 'sync':
+            self.cnc = CNC(device=device)
+        else:
+            raise Exception('Invalid CNC transport.')
+        self.transport = transport
+        self.lastStatusSeq = 0
+
+        # recent status reports, readable without locking
+        self.history = StatusHistory()
 
         # Lock for communicating velocity changes to CNC
         self.cmdLock = Lock()
         self.cmdX = 0
         self.cmdY = 0
 
+        # camera frame that the current command was computed from (for tracing)
+        self.cmdFrame = None
+        self.sentFrame = None
+
         # Lock for communicating status changes from CNC
-        self.statusLock = Lock()
+        self.statusCond = Condition()
         self._status = None
 
         # File handle for logging
@@ -32,26 +56,68 @@ class CncThread(Service):
 
     # overriding method from parent...
     def loopBody(self):
+        if self.transport == 'async':
+            self.asyncBody()
+        else:
+            self.syncBody()
+
+    def asyncBody(self):
+        # commands are sent by the transport as soon as they are set, so
+        # this loop only has to pick up new status reports
+        with self.waiting():
+            result = self.cnc.wait_status(self.lastStatusSeq, timeout=0.1)
+        if result is None:
+            return
+        self.lastStatusSeq, status, statusTime = result
+
+        # store status
+        self.status = status
+        self.history.append(statusTime, status)
+
+        # log status
+        self.logStatus(status)
+
+    def syncBody(self):
         # read command
-        cmdX, cmdY = self.getVel()
+        with self.cmdLock:
+            cmdX, cmdY, cmdFrame = self.cmdX, self.cmdY, self.cmdFrame
+
+        # each frame's command is traced the first time it is sent
+        if cmdFrame is not None and cmdFrame != self.sentFrame:
+            trace.record(cmdFrame, trace.SEND)
+        else:
+            cmdFrame = None
 
         # write velocity, get status
         status = self.cnc.setVel(cmdX, cmdY)
 
         # store status
         self.status = status
+        self.history.append(time(), status)
+
+        if cmdFrame is not None:
+            trace.record(cmdFrame, trace.STATUS)
+            self.sentFrame = cmdFrame
 
         # log status
+        self.logStatus(status)
+
+    def logStatus(self, status):
         logState, logFile = self.getLogState()
         if logState:
-            logStr = (str(time()) + ',' +
-                      str(status.posX) + ',' +
-                      str(status.posY) + '\n')
-            logFile.write(logStr)
+            logFile.append(time(), status.posX, status.posY)
 
-    def setVel(self, cmdX, cmdY):
+    def setVel(self, cmdX, cmdY, frame_id=None):
         with self.cmdLock:
             self.cmdX, self.cmdY = cmdX, cmdY
+            if frame_id is not None:
+                self.cmdFrame = frame_id
+
+            # hand the command straight to the writer
+            if self.transport == 'async':
+                self.cnc.submit(cmdX, cmdY, tag=frame_id)
+
+        trace.record(frame_id, trace.COMMAND)
 
     def getVel(self):
         with self.cmdLock:
@@ -59,13 +125,22 @@ class CncThread(Service):
 
     @property
     def status(self):
-        with self.statusLock:
+        with self.statusCond:
             return self._status
 
     @status.setter
     def status(self, val):
-        with self.statusLock:
+        with self.statusCond:
             self._status = val
+            self.statusCond.notify_all()
+
+    def waitStatus(self, predicate, timeout=None):
+        # block until a status report satisfies predicate; None on timeout
+        with self.statusCond:
+            if self.statusCond.wait_for(lambda: self._status is not None and predicate(self._status), timeout):
+                return self._status
+            else:
+                return None
 
     def startLogging(self, logFile):
         with self.logLock:
@@ -77,8 +152,7 @@ class CncThread(Service):
                 self.logFile.close()
 
             # open new log file if desired
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,x,y\n')
+            self.logFile = logwriter.open_store(logFile, STREAMS['cnc'])
 
     def stopLogging(self):
         with self.logLock:
@@ -93,10 +167,31 @@ class CncThread(Service):
         with self.logLock:
             return self.logState, self.logFile
 
+    def transportStats(self):
+        if self.transport == 'async':
+            return self.cnc.stats()
+        else:
+            return {}
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics['transport'] = self.transportStats()
+        return metrics
+
     def cleanup(self):
-        del self.cnc
+        self.cnc.close()
+
+# status report: flags, X steps, Y steps (signed, big-endian), checksum
+STATUS_FORMAT = struct.Struct('>BhhB')
+
+# position units reported by the Arduino (m per step)
+STEP_SIZE = 25e-6
 
 class CncStatus:
+    # Decoded once, when the report arrives, since the positions and limit
+    # flags are read many times per loop by the tracker, opto and GUI.
+    __slots__ = ['status', 'flags', 'posX', 'posY', 'limN', 'limS', 'limE', 'limW', 'anyLim']
+
     def __init__(self, status):
         # compute checksum
         cksum = sum(status[0:5]) & 0xff
@@ -112,46 +207,94 @@ class CncStatus:
         # save status report
         self.status = status
 
-    @property
-    def limN(self):
-        return bool((self.status[0] >> 1) & 1 == 0)
-
-    @property
-    def limS(self):
-        return bool((self.status[0] >> 2) & 1 == 0)
-
-    @property
-    def limE(self):
-        return bool((self.status[0] >> 3) & 1 == 0)
-
-    @property
-    def limW(self):
-        return bool((self.status[0] >> 4) & 1 == 0)
-
-    @property
-    def anyLim(self):
-        return (0b11100001 | self.status[0]) != 0xff
+        # decode it
+        flags, stepsX, stepsY, _ = STATUS_FORMAT.unpack(bytes(status))
+        self.flags = flags
+        self.posX = stepsX*STEP_SIZE
+        self.posY = stepsY*STEP_SIZE
 
-    @property
-    def posX(self):
-        return CncStatus.posFromByteArr(self.status[1:3])
-
-    @property
-    def posY(self):
-        return CncStatus.posFromByteArr(self.status[3:5])
+        # limit switches pull their bit low when pressed
+        self.limN = (flags >> 1) & 1 == 0
+        self.limS = (flags >> 2) & 1 == 0
+        self.limE = (flags >> 3) & 1 == 0
+        self.limW = (flags >> 4) & 1 == 0
+        self.anyLim = (0b11100001 | flags) != 0xff
 
     @staticmethod
     def posFromByteArr(byteArr):
         intPos = int.from_bytes(byteArr, byteorder='big', signed=True)
-        return intPos*25e-6
+        return intPos*STEP_SIZE
+
+class StatusHistory:
+    # Preallocated ring of recent CNC status reports with their host
+    # receive times.  There is a single writer (CncThread); a row is filled
+    # in before the count is advanced, so readers never need a lock and only
+    # have to check that the rows they copied were not overwritten meanwhile.
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.posX = np.zeros(capacity)
+        self.posY = np.zeros(capacity)
+        self.flags = np.zeros(capacity, dtype=np.uint8)
+        self.count = 0
+
+    def append(self, t, status):
+        index = self.count % self.capacity
+        self.t[index] = t
+        self.posX[index] = status.posX
+        self.posY[index] = status.posY
+        self.flags[index] = status.flags
+        self.count += 1
+
+    def latest(self):
+        # (t, posX, posY) of the most recent status, or None
+        count = self.count
+        if count == 0:
+            return None
+        index = (count - 1) % self.capacity
+        return float(self.t[index]), float(self.posX[index]), float(self.posY[index])
+
+    def recent(self, n=None):
+        # (t, posX, posY) arrays of the last n statuses, oldest first
+        while True:
+            count = self.count
+            if n is None or n > min(count, self.capacity):
+                size = min(count, self.capacity)
+            else:
+                size = n
+            index = np.arange(count - size, count) % self.capacity
+            t, posX, posY = self.t[index], self.posX[index], self.posY[index]
+
+            # retry if the writer wrapped around onto the copied rows
+            if self.count - count + size <= self.capacity:
+                return t, posX, posY
+
+    def interpolate(self, t, n=64):
+        # CNC position at host time t, from the last n statuses; clamped to
+        # the oldest / newest report outside of that range
+        times, posX, posY = self.recent(n)
+        if len(times) == 0:
+            return None
+        return float(np.interp(t, times, posX)), float(np.interp(t, times, posY))
 
 class CNC:
     def __init__(self,
                  com=None, 
                  baud=115200,
                  maxSpeed=0.75, # m/s
-                 bytesPerVel=3
+                 bytesPerVel=3,
+                 device=None # e.g. flyvr.virtual_cnc.VirtualStepper, used instead of the serial port
                  ):
+        # store settings
+        self.maxSpeed = maxSpeed
+        self.bytesPerVel = bytesPerVel
+
+        # connect to a stand-in device
+        if device is not None:
+            self.ser = device.open()
+            return
+
         # set defaults
         if com is None:
             if platform.system() == 'Linux':
@@ -159,16 +302,12 @@ class CNC:
             else:
                 com = 'COM5'
 
-        # store settings
-        self.maxSpeed = maxSpeed
-        self.bytesPerVel = bytesPerVel
-
         # set up serial connection
         self.ser = serial.Serial(port=com, baudrate=baud, bytesize=serial.EIGHTBITS,
                         parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
         sleep(2)
 
-    def setVel(self, velX, velY):
+    def encode(self, velX, velY):
         # format velocity command
         byteArrOut = self.velByte(velX) + self.velByte(velY)
 
@@ -178,8 +317,11 @@ class CNC:
         # append checksum
         byteArrOut += bytearray([ckSumOut])
 
+        return byteArrOut
+
+    def setVel(self, velX, velY):
         # send command over serial interface
-        self.ser.write(byteArrOut)
+        self.ser.write(self.encode(velX, velY))
 
         # read position
         byteArrIn = bytearray(self.ser.read(6))
@@ -187,11 +329,16 @@ class CNC:
         # return status
         return CncStatus(byteArrIn)
 
+    def close(self):
+        # stop the motors and release the serial port
+        if self.ser.is_open:
+            self.setVel(0, 0)
+            self.ser.close()
+
     def __del__(self):
         print('Deleting CNC object...')
-        self.setVel(0, 0)
-        self.ser.close()
-    
+        self.close()
+
     def velByte(self, v):
         # compute maximum integer argument to be sent to Arduino
         signBit = (1 << ((8*self.bytesPerVel)-1))
@@ -210,20 +357,280 @@ class CNC:
 
         return intVal.to_bytes(self.bytesPerVel, byteorder='big', signed=False)
 
-def cnc_home(velX=-0.02, velY=-0.02):
-    cnc = CncThread()
-    cnc.start()
-
-    # wait for initial position report
-    sleep(0.1)
+class AsyncCNC(CNC):
+    # Full-duplex version of the CNC transport.  The Arduino answers every
+    # 7-byte command with a 6-byte status report, so instead of blocking on
+    # each round trip, a writer thread keeps up to maxInFlight commands on
+    # the wire (always the latest velocity) and a reader thread parses
+    # status reports as they arrive, resynchronizing on the checksum if a
+    # byte is lost.  Replies are matched to commands in order, which gives
+    # the round-trip time; a command without a reply after timeout seconds
+    # is given up on.  Status reports carry no sequence number, so a reply
+    # that still arrives for a timed-out command is recognized by order: it
+    # is older than any command in flight.  Such stale replies update the
+    # status but are counted separately and never assigned to a command.
+    # A timed-out command still unanswered after lostAfter seconds is
+    # assumed to have lost its reply, and so is the oldest command for each
+    # reply's worth of bytes skipped while resynchronizing.
+
+    def __init__(self, maxInFlight=2, timeout=50e-3, lostAfter=0.5, **kwargs):
+        super().__init__(**kwargs)
+
+        # short read timeout, so the reader can notice when it should stop
+        self.ser.timeout = 10e-3
+
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.lostAfter = lostAfter
+
+        # latest command (encoded) and its trace tag
+        self.cond = Condition()
+        self.cmd = self.encode(0, 0)
+        self.cmdTag = None
+        self.sentTag = None
+
+        # send times and tags of the commands awaiting a reply, and send
+        # times of the timed-out commands whose replies may still arrive
+        self.inFlight = deque()
+        self.late = deque()
+
+        # latest status report
+        self.statusSeq = 0
+        self.latestStatus = None
+        self.statusTime = None
+
+        # statistics
+        self.rttHist = LatencyHistogram()
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.stale = 0
+        self.lost = 0
+        self.syncErrors = 0
+        self.commErrors = 0
+
+        self.closing = False
+        self.writer = Thread(target=self.writeLoop)
+        self.reader = Thread(target=self.readLoop)
+        self.reader.start()
+        self.writer.start()
+
+    def submit(self, velX, velY, tag=None):
+        # encoded here so that invalid speeds raise in the caller
+        cmd = self.encode(velX, velY)
+        with self.cond:
+            self.cmd = cmd
+            if tag is not None:
+                self.cmdTag = tag
+            self.cond.notify_all()
+
+    def wait_status(self, seq, timeout=None):
+        # block until a status newer than seq arrives; returns (seq, status, time) or None
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.statusSeq > seq or self.closing, timeout):
+                return None
+            if self.statusSeq <= seq:
+                return None
+            return self.statusSeq, self.latestStatus, self.statusTime
 
-    # move to edge
-    cnc.setVel(velX, velY)
-    while (not cnc.status.limS or not cnc.status.limW):
-        cnc.setVel(velX, velY)
+    def setVel(self, velX, velY):
+        # same behavior as CNC.setVel: returns the first status after the command
+        with self.cond:
+            seq = self.statusSeq
+        self.submit(velX, velY)
+        result = self.wait_status(seq + self.maxInFlight, timeout=1.0)
+        if result is None:
+            raise Exception('No status report from CNC.')
+        return result[1]
+
+    def writeLoop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closing or len(self.inFlight) < self.maxInFlight,
+                                   self.timeout)
+
+                # give up on commands that were never answered
+                now = perf_counter()
+                while self.inFlight and now - self.inFlight[0][0] > self.timeout:
+                    self.late.append(self.inFlight.popleft()[0])
+                    self.timeouts += 1
+
+                if self.closing:
+                    return
+                if len(self.inFlight) >= self.maxInFlight:
+                    continue
+
+                # always send the latest command; each tag is traced once
+                cmd = self.cmd
+                tag = self.cmdTag if self.cmdTag != self.sentTag else None
+                self.sentTag = self.cmdTag
+                self.inFlight.append((perf_counter(), tag))
+
+            trace.record(tag, trace.SEND)
+            self.ser.write(cmd)
+            self.sent += 1
+
+    def readLoop(self):
+        buf = bytearray()
+        skipped = 0
+        while not self.closing:
+            buf += self.ser.read(max(self.ser.in_waiting, 1))
+
+            while len(buf) >= 6:
+                # drop bytes until the checksum lines up
+                if sum(buf[0:5]) & 0xff != buf[5]:
+                    del buf[0]
+                    self.syncErrors += 1
+                    skipped += 1
+                    continue
+
+                # the skipped bytes were replies to the oldest commands
+                if skipped > 0:
+                    self.retireLost(-(-skipped//6))
+                    skipped = 0
+
+                frame = bytearray(buf[0:6])
+                del buf[0:6]
+                self.handleFrame(frame)
+
+    def retireLost(self, count):
+        # give up on the replies to the count oldest commands
+        with self.cond:
+            for _ in range(count):
+                if self.late:
+                    self.late.popleft()
+                elif self.inFlight:
+                    self.inFlight.popleft()
+                else:
+                    break
+                self.lost += 1
+            self.cond.notify_all()
+
+    def handleFrame(self, frame):
+        now = perf_counter()
+        with self.cond:
+            # replies owed to timed-out commands come first
+            while self.late and now - self.late[0] > self.lostAfter:
+                self.late.popleft()
+                self.lost += 1
+            if self.late:
+                self.late.popleft()
+                self.stale += 1
+                sendTime, tag = None, None
+            else:
+                sendTime, tag = self.inFlight.popleft() if self.inFlight else (None, None)
+            self.cond.notify_all()
+        self.received += 1
+        if sendTime is not None:
+            self.rttHist.record(now - sendTime)
+
+        # the Arduino ignored a command with a bad checksum
+        if frame[0] & 1 == 1:
+            self.commErrors += 1
+            return
+
+        status = CncStatus(frame)
+        with self.cond:
+            self.latestStatus = status
+            self.statusTime = time()
+            self.statusSeq += 1
+            self.cond.notify_all()
+
+        trace.record(tag, trace.STATUS)
+
+    def stats(self):
+        return {'sent': self.sent,
+                'received': self.received,
+                'in_flight': len(self.inFlight),
+                'timeouts': self.timeouts,
+                'stale': self.stale,
+                'lost': self.lost,
+                'sync_errors': self.syncErrors,
+                'comm_errors': self.commErrors,
+                'rtt': self.rttHist.snapshot()}
+
+    def close(self):
+        if self.closing:
+            return
+
+        # stop the motors and give the command a chance to go out
+        try:
+            self.setVel(0, 0)
+        except Exception as e:
+            print('Could not stop CNC: {}'.format(e))
+
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.writer.join()
+        self.reader.join()
+        self.ser.close()
 
-    # set velocity to zero and wait for it to take effect
-    cnc.setVel(0, 0)
-    sleep(0.1)
+def move_until(cnc, velX, velY, doneX, doneY, timeout, maxAcc=None):
+    # drive each axis at its velocity until its done(status) condition holds,
+    # waking up on status reports rather than polling; with maxAcc (m/s^2)
+    # the speed is ramped up from rest instead of commanded as a step
+    startTime = time()
+    peakVel = max(abs(velX), abs(velY))
+    while True:
+        scale = 1
+        if maxAcc is not None and peakVel > 0:
+            scale = min(1, maxAcc*(time() - startTime)/peakVel)
+
+        status = cnc.status
+        moveX = not doneX(status)
+        moveY = not doneY(status)
+        cnc.setVel(scale*velX if moveX else 0, scale*velY if moveY else 0)
+        if not moveX and not moveY:
+            return status
+
+        # while ramping, come back for the next speed step
+        ramping = scale < 1
+        status = cnc.waitStatus(lambda s: (moveX and doneX(s)) or (moveY and doneY(s)),
+                                10e-3 if ramping else timeout)
+        if status is None and not ramping:
+            cnc.setVel(0, 0)
+            raise Exception('CNC homing timed out.')
+
+def cnc_home(fastVel=0.02, slowVel=5e-3, backoff=2e-3, maxAcc=1, timeout=60, device=None):
+    # Home against the S and W limit switches: approach them fast, back off,
+    # then approach again slowly so that the final position does not depend
+    # on the approach speed.  The Arduino resets its position counter when
+    # the serial port is opened again, which makes the limits the origin.
+    # The firmware stops an axis dead when it reaches its limit switch, and
+    # the switch position is not known in advance, so the approach speed is
+    # what the gantry hits the switch at: fastVel defaults to the speed the
+    # gantry has always been homed at.  Moves start from rest with the speed
+    # ramped up at maxAcc (the tracker's acceleration limit).
+    startTime = time()
+
+    cnc = CncThread(device=device)
+    cnc.start()
 
-    cnc.stop()
\ No newline at end of file
+    try:
+        # wait for initial position report
+        if cnc.waitStatus(lambda s: True, timeout=1.0) is None:
+            raise Exception('No status report from CNC.')
+
+        # fast approach
+        move_until(cnc, -fastVel, -fastVel, lambda s: s.limS, lambda s: s.limW, timeout, maxAcc)
+
+        # back off until the switches are released and we are clear of them
+        start = cnc.status
+        move_until(cnc, fastVel, fastVel,
+                   lambda s: not s.limS and s.posX - start.posX >= backoff,
+                   lambda s: not s.limW and s.posY - start.posY >= backoff,
+                   timeout, maxAcc)
+
+        # slow approach
+        move_until(cnc, -slowVel, -slowVel, lambda s: s.limS, lambda s: s.limW, timeout)
+    finally:
+        # set velocity to zero and wait for it to take effect
+        cnc.setVel(0, 0)
+        sleep(0.1)
+        cnc.stop()
+
+    duration = time() - startTime
+    print('CNC homed in {:0.2f} s.'.format(duration))
+
+    return duration
@@ -12,13 +12,8 @@ from flyrpc.util import get_kwargs
 
 from flyvr.util import serial_number_to_comport
 from flyvr.service import Service
-
-def format_values(values, delimeter='\t', line_ending='\n'):
-    retval = [str(value) for value in values]
-    retval = delimeter.join(retval)
-    retval += line_ending
-
-    return retval
+from flyvr import logwriter
+from flyvr.gatelog import gate_columns
 
 class FlyDispenser(Service):
     def __init__(self, maxTime=12e-3):
@@ -255,14 +250,15 @@ class FlyDispenser(Service):
         self.should_release.clear()
 
     def read_frame(self):
-        start_byte = self.conn.read(1)[0]
+        with self.waiting():
+            start_byte = self.conn.read(1)[0]
         if int(start_byte) == 0:
             if not self.synced:
                 print('Dispenser camera is synced.')
                 self.synced = True
             # read raw data into a list
-            frame = self.conn.read(self.num_pixels)
-            frame = list(frame)
+            raw = self.conn.read(self.num_pixels)
+            frame = list(raw)
 
             # write frame to variable for matplotlib display
             if self.display_type == 'raw':
@@ -284,7 +280,7 @@ class FlyDispenser(Service):
             self.display_frame = display_frame
 
             # write frame to file
-            self.log_raw(frame)
+            self.log_raw(raw)
 
             # save previous frame for difference calculation if desired
             self.prev_frame = self.raw_data
@@ -385,18 +381,19 @@ class FlyDispenser(Service):
                 self.gate_times_file.flush()
                 self.trigger = None
 
-    def log_raw(self, frame):
+    def log_raw(self, raw):
         with self.log_lock:
-            if self.raw_data_file is not None:
-                self.raw_data_file.write(format_values(frame))
-                self.raw_data_file.flush()
+            # skip frames cut short by a read timeout
+            if self.raw_data_file is not None and len(raw) == self.num_pixels:
+                self.raw_data_file.append(time(), np.frombuffer(raw, dtype=np.uint8))
 
     def start_logging(self, exp_dir):
         with self.log_lock:
             self.close_all_open_files()
 
-            self.raw_data_file = open(os.path.join(exp_dir, 'raw_gate_data.txt'), 'w')
-            self.gate_times_file = open(os.path.join(exp_dir, 'gate_data.txt'), 'w')
+            self.raw_data_file = logwriter.open_store(os.path.join(exp_dir, 'raw_gate_data.bin'),
+                                                      gate_columns(self.num_pixels))
+            self.gate_times_file = logwriter.open_text(os.path.join(exp_dir, 'gate_data.txt'))
 
     def stop_logging(self):
         with self.log_lock:
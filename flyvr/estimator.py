@@ -0,0 +1,234 @@
+import csv
+import os
+import sys
+
+import numpy as np
+
+from flyvr.store import read_stream
+
+# Estimate of the fly's position and velocity in arena coordinates, fused
+# from camera poses and CNC status reports.  A camera pose is the fly's
+# offset from the image center at the time the frame was captured, so the
+# fly's arena position is that offset plus where the gantry was at the same
+# moment (interpolated from the CNC status history).  These measurements
+# drive a constant-velocity Kalman filter per axis, which can then be
+# extrapolated to the time a velocity command will actually take effect,
+# instead of acting on a frame that is already several milliseconds old
+# while the gantry keeps moving.
+#
+# All times are host times from time(), like Pose.host_time and the CNC
+# status history.
+#
+# Offline evaluation on a recorded trial:
+#     python -m flyvr.estimator <trial_dir> [lead_time]
+# which reads cam.bin / cnc.bin, or cam.txt / cnc.txt for older trials.
+
+class FlyEstimator:
+    def __init__(self,
+                 accel_noise=4.0, # m/s^2, RMS acceleration of the fly over one frame
+                 meas_noise=0.3e-3, # m, RMS error of a single position measurement
+                 init_vel=0.02, # m/s, RMS fly velocity when a track starts
+                 max_gap=0.25, # s, restart the track after this long without a measurement
+                 gate=25, # squared Mahalanobis distance above which a measurement is rejected
+                 max_rejects=3 # restart the track after this many rejected measurements in a row
+                 ):
+        self.q = accel_noise**2
+        self.r = meas_noise**2
+        self.init_vel = init_vel
+        self.max_gap = max_gap
+        self.gate = gate
+        self.max_rejects = max_rejects
+
+        # statistics
+        self.updates = 0
+        self.rejects = 0
+        self.restarts = 0
+
+        self.reset()
+
+    def reset(self):
+        self.t = None
+        self.consecutiveRejects = 0
+
+        # per axis: state (position, velocity) and its covariance
+        self.x = np.zeros((2, 2))
+        self.P = np.zeros((2, 2, 2))
+
+    def start(self, t, posX, posY):
+        self.t = t
+        self.x[:, 0] = posX, posY
+        self.x[:, 1] = 0
+        self.P[:] = np.diag([self.r, self.init_vel**2])
+        self.consecutiveRejects = 0
+        self.restarts += 1
+
+    def propagate(self, dt):
+        # constant-velocity model, driven by white-noise acceleration
+        F = np.array([[1, dt], [0, 1]])
+        Q = self.q*np.array([[dt**4/4, dt**3/2], [dt**3/2, dt**2]])
+        x = self.x @ F.T
+        P = F @ self.P @ F.T + Q
+        return x, P
+
+    def update(self, t, posX, posY):
+        # fuse the fly's arena position measured at time t
+        if self.t is None or t - self.t > self.max_gap:
+            self.start(t, posX, posY)
+            return True
+
+        # measurements arrive in frame order; anything older adds nothing
+        dt = t - self.t
+        if dt < 0:
+            return False
+        x, P = self.propagate(dt)
+
+        # innovation and its variance, per axis
+        z = np.array([posX, posY])
+        innov = z - x[:, 0]
+        S = P[:, 0, 0] + self.r
+
+        # reject outliers (e.g. a different blob); keep rejecting and the fly has moved on
+        if np.sum(innov**2/S) > self.gate:
+            self.rejects += 1
+            self.consecutiveRejects += 1
+            if self.consecutiveRejects >= self.max_rejects:
+                self.start(t, posX, posY)
+                return True
+            return False
+        self.consecutiveRejects = 0
+
+        K = P[:, :, 0]/S[:, None]
+        self.x = x + K*innov[:, None]
+        self.P = P - K[:, :, None]*P[:, None, 0, :]
+        self.t = t
+        self.updates += 1
+        return True
+
+    def predict(self, t):
+        # (posX, posY, velX, velY) extrapolated to time t, or None without a current track
+        if self.t is None or t - self.t > self.max_gap:
+            return None
+        x, _ = self.propagate(max(t - self.t, 0))
+        return float(x[0, 0]), float(x[1, 0]), float(x[0, 1]), float(x[1, 1])
+
+    def stats(self):
+        return {'updates': self.updates,
+                'rejects': self.rejects,
+                'restarts': self.restarts}
+
+# offline evaluation
+
+def load_cam(trial_dir):
+    # frame time and camera offset of the fly in each logged frame
+    path = os.path.join(trial_dir, 'cam.bin')
+    if os.path.isfile(path):
+        cam = read_stream(path)
+        # the row is logged after detection; the frame arrived latency earlier
+        latency = np.where(np.isnan(cam['latency']), 0, cam['latency'])
+        return cam['t'] - latency, cam['x'], cam['y']
+
+    tvec = []
+    xvec = []
+    yvec = []
+    with open(os.path.join(trial_dir, 'cam.txt'), 'r') as f:
+        for row in csv.DictReader(f):
+            t = float(row['t'])
+            latency = row.get('latency')
+            if latency not in [None, '', 'None']:
+                t -= float(latency)
+            tvec.append(t)
+            xvec.append(float(row['x']))
+            yvec.append(float(row['y']))
+    return np.array(tvec), np.array(xvec), np.array(yvec)
+
+def load_cnc(trial_dir):
+    path = os.path.join(trial_dir, 'cnc.bin')
+    if os.path.isfile(path):
+        cnc = read_stream(path)
+        return cnc['t'], cnc['x'], cnc['y']
+
+    path = os.path.join(trial_dir, 'cnc.txt')
+    data = np.genfromtxt(path, delimiter=',', skip_header=1, usecols=(0, 1, 2), ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+def error_stats(err):
+    err = err[np.isfinite(err)]
+    if len(err) == 0:
+        return {'count': 0, 'rms': None, 'p90': None, 'max': None}
+    return {'count': len(err),
+            'rms': float(np.sqrt(np.mean(err**2))),
+            'p90': float(np.percentile(err, 90)),
+            'max': float(np.max(err))}
+
+def evaluate(trial_dir, lead_time=5e-3, **kwargs):
+    # Replays the cam / cnc logs through the estimator.  After each frame the
+    # fly's offset from the gantry is predicted lead_time ahead and compared
+    # with the offset actually observed then (interpolated between frames);
+    # the baseline is the raw offset of the latest frame, which is what the
+    # controller acts on without the estimator.
+    camT, camX, camY = load_cam(trial_dir)
+    cncT, cncX, cncY = load_cnc(trial_dir)
+
+    # fly arena position at each frame
+    flyX = camX + np.interp(camT, cncT, cncX)
+    flyY = camY + np.interp(camT, cncT, cncY)
+
+    estimator = FlyEstimator(**kwargs)
+
+    # gantry velocity from its own log, for extrapolating the gantry position
+    cncVelX = np.gradient(cncX, cncT) if len(cncT) > 1 else np.zeros(len(cncT))
+    cncVelY = np.gradient(cncY, cncT) if len(cncT) > 1 else np.zeros(len(cncT))
+
+    rawErr = np.full(len(camT), np.nan)
+    estErr = np.full(len(camT), np.nan)
+    for k in range(len(camT)):
+        estimator.update(camT[k], flyX[k], flyY[k])
+
+        # true offset at the target time, only where it lies between two frames
+        target = camT[k] + lead_time
+        j = np.searchsorted(camT, target)
+        if j >= len(camT) or camT[j] - camT[j-1] > estimator.max_gap:
+            continue
+        trueX = np.interp(target, camT, camX)
+        trueY = np.interp(target, camT, camY)
+
+        rawErr[k] = np.hypot(camX[k] - trueX, camY[k] - trueY)
+
+        pred = estimator.predict(target)
+        if pred is None:
+            continue
+
+        # gantry position at the target time, from the last status before the frame
+        i = max(np.searchsorted(cncT, camT[k]) - 1, 0)
+        gantryX = cncX[i] + cncVelX[i]*(target - cncT[i])
+        gantryY = cncY[i] + cncVelY[i]*(target - cncT[i])
+        estErr[k] = np.hypot(pred[0] - gantryX - trueX, pred[1] - gantryY - trueY)
+
+    return {'frames': len(camT),
+            'lead_time': lead_time,
+            'raw': error_stats(rawErr),
+            'estimator': error_stats(estErr),
+            'filter': estimator.stats()}
+
+def format_result(result):
+    lines = ['{} frames, offset error {:0.1f} ms ahead (mm):'.format(result['frames'], 1e3*result['lead_time']),
+             '{:<12}{:>8}{:>8}{:>8}{:>8}'.format('', 'count', 'rms', 'p90', 'max')]
+    for name in ['raw', 'estimator']:
+        stats = result[name]
+        values = [stats[key] for key in ['rms', 'p90', 'max']]
+        lines.append('{:<12}{:>8}'.format(name, stats['count']) +
+                     ''.join('{:>8}'.format('-' if v is None else '{:0.3f}'.format(1e3*v)) for v in values))
+    lines.append('filter: {updates} updates, {rejects} rejected, {restarts} (re)starts'.format(**result['filter']))
+    return '\n'.join(lines)
+
+def main():
+    # usage: python -m flyvr.estimator trial_dir [lead_time]
+    if len(sys.argv) < 2:
+        print('usage: python -m flyvr.estimator <trial_dir> [lead_time]')
+        return
+
+    lead_time = float(sys.argv[2]) if len(sys.argv) > 2 else 5e-3
+    print(format_result(evaluate(sys.argv[1], lead_time=lead_time)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os.path
+import sys
+
+import numpy as np
+
+from flyvr.store import StoreWriter, read_stream
+
+# Log of the dispenser's line-scan camera.  raw_gate_data.bin is a
+# flyvr.store stream with the host time each frame was read and the frame
+# itself (num_pixels uint8 values) in every row.  Older experiments have
+# raw_gate_data.txt instead, with one tab-separated frame per line and no
+# timestamps; convert those with
+#     python -m flyvr.gatelog raw_gate_data.txt [raw_gate_data.bin]
+
+def gate_columns(num_pixels):
+    return [('t', '<f8'), ('frame', '|u1', (num_pixels,))]
+
+def read_gate_text(path):
+    frames = np.loadtxt(path, dtype=np.uint8, ndmin=2)
+    return np.full(len(frames), np.nan), frames
+
+def read_gate_log(path):
+    # (t, frames): host times (NaN for old text logs) and frames, one row each
+    if path.endswith('.txt'):
+        return read_gate_text(path)
+    data = read_stream(path)
+    return data['t'], data['frame']
+
+def convert_text(path, out=None):
+    # rewrite an old text log in the binary format, one line at a time
+    if out is None:
+        out = os.path.splitext(path)[0] + '.bin'
+
+    writer = None
+    with open(path, 'r') as f:
+        for line in f:
+            values = line.split()
+            if not values:
+                continue
+            frame = np.array(values, dtype=np.uint8)
+            if writer is None:
+                writer = StoreWriter(out, gate_columns(len(frame)))
+            writer.append(np.nan, frame)
+
+    if writer is None:
+        raise Exception('No frames in {}.'.format(path))
+    writer.close()
+    return out, writer.total
+
+def main():
+    # usage: python -m flyvr.gatelog raw_gate_data.txt [out.bin]
+    if len(sys.argv) < 2:
+        print('usage: python -m flyvr.gatelog <raw_gate_data.txt> [out.bin]')
+        return
+
+    out, count = convert_text(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print('Wrote {} frames to {}.'.format(count, out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import atexit
+
+from collections import deque
+from threading import Thread, Event, Lock
+from time import perf_counter
+
+from flyvr.service import Service
+from flyvr.store import StoreWriter
+
+# Shared background writer for the trial logs.  Services open their logs
+# through open_store() / open_text() and get a Log back, whose append() and
+# write() only put the record on a queue; a single LogWriter thread takes
+# the records off in batches and does the actual file I/O, so no service
+# loop ever blocks on the disk.
+#
+# The queue is a collections.deque, whose append() and popleft() are atomic
+# in CPython, so producers never take a lock.  The writer polls it every
+# poll seconds instead of being woken per record, which keeps the producer
+# side to a single append.  When more than high_water records are waiting,
+# new records are dropped and counted (per log and in total) rather than
+# letting memory grow without bound.  Open logs are flushed to disk every
+# flush_interval seconds, and flush() waits until everything queued so far
+# has been written.
+
+APPEND = 0
+WRITE = 1
+FLUSH = 2
+OPEN = 3
+CLOSE = 4
+BARRIER = 5
+
+class Log:
+    def __init__(self, writer, sink, name):
+        self.writer = writer
+        self.sink = sink
+        self.name = name
+
+        # updated by the writer thread, except for dropped
+        self.records = 0
+        self.dropped = 0
+        self.dirty = False
+
+    def append(self, *row):
+        # row for a StoreWriter sink; False if it was dropped
+        return self.writer.put(self, APPEND, row)
+
+    def write(self, text):
+        # text for a file sink; False if it was dropped
+        return self.writer.put(self, WRITE, text)
+
+    def flush(self):
+        # ask for what is queued so far to go to disk soon, without waiting
+        self.writer.control(self, FLUSH)
+
+    def close(self):
+        # queued records are still written before the file is closed
+        self.writer.control(self, CLOSE)
+
+class LogWriter(Service):
+    def __init__(self, flush_interval=0.5, high_water=100000, poll=20e-3, warnInterval=1.0):
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.poll = poll
+
+        self.queue = deque()
+        self.wake = Event()
+        self.logs = []
+        self.lastFlush = perf_counter()
+
+        # statistics
+        self.records = 0
+        self.dropped = 0
+        self.errors = 0
+        self.peak = 0
+        self.batchMax = 0
+        self.reportedDrops = 0
+        self.lastDropWarn = None
+
+        # call constructor from parent
+        super().__init__(iter_warn=False, warnInterval=warnInterval)
+
+    def start(self):
+        # a daemon thread, so that a writer nobody stops does not keep the
+        # program alive; shutdown() at exit still writes out what is queued
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    # producer side
+
+    def put(self, log, op, payload):
+        queued = len(self.queue)
+        if queued >= self.high_water:
+            log.dropped += 1
+            self.dropped += 1
+            return False
+        self.queue.append((log, op, payload))
+        if queued >= self.peak:
+            self.peak = queued + 1
+        return True
+
+    def control(self, log, op, payload=None):
+        # control operations are never dropped, and are handled right away
+        self.queue.append((log, op, payload))
+        self.wake.set()
+
+    def open(self, sink, name):
+        log = Log(self, sink, name)
+        self.control(log, OPEN)
+        return log
+
+    def flush(self, timeout=5.0):
+        # wait until everything queued so far is written and flushed
+        done = Event()
+        self.control(None, BARRIER, done)
+        if not self.thread.is_alive():
+            self.drain()
+        return done.wait(timeout)
+
+    # writer side
+
+    def loopBody(self):
+        self.wake.wait(self.poll)
+        self.wake.clear()
+        self.drain()
+
+        now = perf_counter()
+        if now - self.lastFlush >= self.flush_interval:
+            self.flushLogs()
+            self.lastFlush = now
+
+        # report drops, at most once per warnInterval
+        if self.dropped != self.reportedDrops:
+            if self.lastDropWarn is None or now - self.lastDropWarn >= self.warnInterval:
+                print('LogWriter: queue above {} records, dropped {} so far.'.format(
+                    self.high_water, self.dropped))
+                self.reportedDrops = self.dropped
+                self.lastDropWarn = now
+
+    def drain(self):
+        count = 0
+        while True:
+            try:
+                log, op, payload = self.queue.popleft()
+            except IndexError:
+                break
+
+            try:
+                if op == APPEND:
+                    log.sink.append(*payload)
+                    log.records += 1
+                    log.dirty = True
+                    count += 1
+                elif op == WRITE:
+                    log.sink.write(payload)
+                    log.records += 1
+                    log.dirty = True
+                    count += 1
+                elif op == FLUSH:
+                    self.flushLog(log)
+                elif op == OPEN:
+                    self.logs.append(log)
+                elif op == CLOSE:
+                    if log in self.logs:
+                        self.logs.remove(log)
+                    log.sink.close()
+                elif op == BARRIER:
+                    self.flushLogs()
+                    payload.set()
+            except Exception as e:
+                self.errors += 1
+                print('LogWriter: could not write to {} ({}).'.format(log.name if log is not None else 'logs', e))
+
+        self.records += count
+        self.batchMax = max(self.batchMax, count)
+
+    def flushLog(self, log):
+        if log.dirty and log in self.logs:
+            log.sink.flush()
+            log.dirty = False
+
+    def flushLogs(self):
+        for log in self.logs:
+            try:
+                self.flushLog(log)
+            except Exception as e:
+                self.errors += 1
+                print('LogWriter: could not flush {} ({}).'.format(log.name, e))
+
+    def cleanup(self):
+        # write out and close whatever is left
+        self.drain()
+        for log in self.logs:
+            log.sink.close()
+        self.logs = []
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics['logs'] = {'queued': len(self.queue),
+                           'peak': self.peak,
+                           'high_water': self.high_water,
+                           'records': self.records,
+                           'dropped': self.dropped,
+                           'errors': self.errors,
+                           'batch_max': self.batchMax,
+                           'dropped_by_log': {log.name: log.dropped for log in list(self.logs) if log.dropped > 0}}
+        return metrics
+
+# the writer shared by all services, started when the first log is opened
+_writer = None
+_writerLock = Lock()
+
+def get_writer():
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = LogWriter()
+            _writer.start()
+        return _writer
+
+def open_store(path, columns, **kwargs):
+    # binary column log (flyvr.store)
+    return get_writer().open(StoreWriter(path, columns, **kwargs), path)
+
+def open_text(path, mode='w'):
+    return get_writer().open(open(path, mode), path)
+
+def flush(timeout=5.0):
+    # make sure everything logged so far is on disk
+    if _writer is None:
+        return True
+    return _writer.flush(timeout)
+
+def shutdown():
+    global _writer
+    with _writerLock:
+        writer = _writer
+        _writer = None
+    if writer is not None and writer.thread.is_alive():
+        writer.stop()
+
+atexit.register(shutdown)
@@ -0,0 +1,203 @@
+import json
+import os
+import sys
+import weakref
+import numpy as np
+
+from math import log
+from time import time, sleep
+from threading import Thread, Event, Lock
+
+class LatencyHistogram:
+    # Streaming histogram of durations (s) with logarithmic buckets, in the
+    # spirit of HdrHistogram: every bucket is a fixed fraction wider than the
+    # previous one, so quantiles have the same relative error (precision)
+    # from microseconds up to the highest trackable value.  Recording is
+    # O(1) and never allocates, so it is cheap enough for every loop
+    # iteration.  There is a single writer (the owning service); readers
+    # take snapshots without locking.
+
+    def __init__(self, lowest=1e-6, highest=100.0, precision=0.01):
+        self.lowest = lowest
+        self.highest = highest
+        self.scale = 1/log(1 + precision)
+        self.num_buckets = int(log(highest/lowest)*self.scale) + 2
+        self.reset()
+
+    def reset(self):
+        # bucket 0 collects everything below lowest
+        self.counts = np.zeros(self.num_buckets, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value < self.lowest:
+            index = 0
+        else:
+            index = min(int(log(value/self.lowest)*self.scale) + 1, self.num_buckets - 1)
+        self.counts[index] += 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        # upper edge of a bucket
+        return self.lowest*np.exp(index/self.scale)
+
+    def percentile(self, q):
+        # value below which q percent of the recorded values fall
+        counts = self.counts.copy()
+        total = counts.sum()
+        if total == 0:
+            return None
+
+        rank = max(int(np.ceil(q/100*total)), 1)
+        index = int(np.searchsorted(np.cumsum(counts), rank))
+        if index == 0:
+            return self.min
+
+        # never report more than was actually seen
+        value = float(self.bucket_value(index))
+        if self.max is not None:
+            value = min(value, self.max)
+        return value
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total/self.count
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'min': self.min,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9),
+                'max': self.max}
+
+# registry of every live Service, used by snapshot_all()
+_registryLock = Lock()
+_services = weakref.WeakSet()
+
+def register(service):
+    with _registryLock:
+        _services.add(service)
+
+def services():
+    with _registryLock:
+        return list(_services)
+
+def service_name(service):
+    return getattr(service, 'name', None) or service.__class__.__name__
+
+def snapshot_all():
+    # metrics of every registered service, keyed by service name; services
+    # running in another process (CamProcess) add theirs as '<name>/<service>'
+    snapshot = {}
+    for service in sorted(services(), key=service_name):
+        name = service_name(service)
+        key = name
+        count = 2
+        while key in snapshot:
+            key = '{}#{}'.format(name, count)
+            count += 1
+        snapshot[key] = service.metrics()
+
+        remoteMetrics = getattr(service, 'remoteMetrics', None)
+        if remoteMetrics is not None:
+            try:
+                remote = remoteMetrics()
+            except Exception:
+                # the other process is not running (yet, or any more)
+                continue
+            for remoteName, metrics in remote.items():
+                snapshot['{}/{}'.format(key, remoteName)] = metrics
+    return snapshot
+
+def write_snapshot(path):
+    # write atomically so that readers never see a partial file
+    data = {'time': time(), 'services': snapshot_all()}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+class MetricsDumper:
+    # Periodically writes snapshot_all() to a JSON file so that metrics can
+    # be watched from another process with "python -m flyvr.metrics <path>".
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.done = Event()
+
+    def start(self):
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def loop(self):
+        # one last snapshot is written after stop() is called
+        while True:
+            stopping = self.done.wait(self.interval)
+            try:
+                write_snapshot(self.path)
+            except Exception as e:
+                print('Could not write metrics: {}'.format(e))
+            if stopping:
+                break
+
+def format_ms(value):
+    if value is None:
+        return '-'
+    return '{:0.2f}'.format(value*1e3)
+
+def format_table(snapshot):
+    # one line per service with body time and period quantiles (ms), the
+    # iterations that missed their deadline (overrun) and the ones whose
+    # body took longer than maxTime (slow); a late iteration is often also
+    # slow, so the two are shown separately rather than added up
+    header = '{:<20} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'service', 'iters', 'body p50', 'p99', 'max', 'per p50', 'p99', 'max', 'overrun', 'slow')
+    lines = [header]
+    for name, m in snapshot.items():
+        lines.append('{:<20} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            name[:20], m['iterations'],
+            format_ms(m['body']['p50']), format_ms(m['body']['p99']), format_ms(m['body']['max']),
+            format_ms(m['period']['p50']), format_ms(m['period']['p99']), format_ms(m['period']['max']),
+            m['overruns'], m['slow']))
+    return '\n'.join(lines)
+
+def main():
+    # usage: python -m flyvr.metrics metrics.json [--watch]
+    if len(sys.argv) < 2:
+        print('usage: python -m flyvr.metrics <metrics.json> [--watch]')
+        return
+
+    path = sys.argv[1]
+    watch = '--watch' in sys.argv[2:]
+
+    while True:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        print('{} ({:0.1f} s old)'.format(path, time() - data['time']))
+        print(format_table(data['services']))
+        if not watch:
+            break
+        print()
+        sleep(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from math import sqrt, cos, sin, pi
+
+class MoveProfile:
+    # Point-to-point move along a straight line, with the speed ramped up
+    # and down within the velocity and acceleration limits.  The ramps are
+    # either linear ('trapezoid', constant acceleration) or raised-cosine
+    # ('scurve', acceleration rising and falling smoothly, so the jerk is
+    # bounded); an S-curve ramp takes pi/2 times as long for the same peak
+    # acceleration.  Moves that are too short to reach maxVel get a
+    # triangular (or bell-shaped) speed profile instead.
+
+    def __init__(self, startX, startY, endX, endY, maxVel, maxAcc, kind='trapezoid'):
+        if kind not in ['trapezoid', 'scurve']:
+            raise Exception('Invalid move profile.')
+        self.kind = kind
+
+        self.startX = startX
+        self.startY = startY
+        self.endX = endX
+        self.endY = endY
+
+        # unit vector along the move
+        dx = endX - startX
+        dy = endY - startY
+        self.distance = sqrt(dx*dx + dy*dy)
+        if self.distance > 0:
+            self.ux = dx/self.distance
+            self.uy = dy/self.distance
+        else:
+            self.ux = 0
+            self.uy = 0
+
+        # ramp time for a given speed: v/a for linear, (pi/2)v/a for raised cosine
+        self.rampFactor = 1 if kind == 'trapezoid' else pi/2
+
+        # peak speed, limited by the distance available for both ramps
+        self.peakVel = min(maxVel, sqrt(self.distance*maxAcc/self.rampFactor))
+        if self.peakVel > 0:
+            self.rampTime = self.rampFactor*self.peakVel/maxAcc
+            self.cruiseTime = self.distance/self.peakVel - self.rampTime
+        else:
+            self.rampTime = 0
+            self.cruiseTime = 0
+
+        self.duration = 2*self.rampTime + self.cruiseTime
+
+    def ramp(self, t):
+        # speed and distance covered t seconds into an acceleration ramp
+        if self.kind == 'trapezoid':
+            speed = self.peakVel*t/self.rampTime
+            dist = 0.5*speed*t
+        else:
+            w = pi/self.rampTime
+            speed = 0.5*self.peakVel*(1 - cos(w*t))
+            dist = 0.5*self.peakVel*(t - sin(w*t)/w)
+        return speed, dist
+
+    def along(self, t):
+        # speed and distance along the move at time t
+        if t <= 0 or self.distance == 0:
+            return 0, 0
+        elif t >= self.duration:
+            return 0, self.distance
+        elif t < self.rampTime:
+            return self.ramp(t)
+        elif t < self.rampTime + self.cruiseTime:
+            rampDist = 0.5*self.peakVel*self.rampTime
+            return self.peakVel, rampDist + self.peakVel*(t - self.rampTime)
+        else:
+            # deceleration mirrors the acceleration ramp
+            speed, dist = self.ramp(self.duration - t)
+            return speed, self.distance - dist
+
+    def sample(self, t):
+        # (posX, posY, velX, velY) at time t since the start of the move
+        speed, dist = self.along(t)
+        return (self.startX + self.ux*dist, self.startY + self.uy*dist,
+                self.ux*speed, self.uy*speed)
@@ -14,6 +14,8 @@ from flyvr.cnc import CncThread
 from flyvr.camera import CamThread
 
 from flyvr.util import serial_number_to_comport
+from flyvr.store import STREAMS, OPTO_LED, OPTO_FOOD, OPTO_FOOD_REMOVED
+from flyvr import logwriter
 from random import choice
 
 class OptoThread(Service):
@@ -130,9 +132,10 @@ class OptoThread(Service):
 
         ### Get Fly Position ###
 
-        if self.camThread is not None and self.camThread.fly is not None:
-            self.camX = self.camThread.fly.centerX
-            self.camY = self.camThread.fly.centerY
+        pose = self.camThread.pose if self.camThread is not None else None
+        if pose is not None and pose.present:
+            self.camX = pose.x
+            self.camY = pose.y
         else:
             self.camX = None
             self.camY = None
@@ -468,21 +471,21 @@ class OptoThread(Service):
         with self.logLock:
             if self.logFile is not None:
                 print("log file not none in led status logging")
-                self.logFile.write('{}, {}, {}\n'.format('led', time(), led_status))
+                self.logFile.append(time(), OPTO_LED, led_status == 'on', np.nan, np.nan)
                 self.logFile.flush()
 
     def logFood(self, x, y):
         #print("log food called")
         with self.logLock:
             if self.logFile is not None:
-                self.logFile.write('{}, {}, {}, {}\n'.format('food', time(), x, y))
+                self.logFile.append(time(), OPTO_FOOD, -1, x, y)
                 self.logFile.flush()
                 print("foodspot logged")
 
     def logFoodRemoval(self):
         with self.logLock:
             if self.logFile is not None:
-                self.logFile.write('{}, {}\n'.format('food-removed', time()))
+                self.logFile.append(time(), OPTO_FOOD_REMOVED, -1, np.nan, np.nan)
                 self.logFile.flush()
 
     # def logFoodRevisitNoFood(self, x, y):
@@ -499,9 +502,8 @@ class OptoThread(Service):
                 self.logFile.close()
                 print("log file closed")
 
-            self.logFile = open(logFile, 'w')
+            self.logFile = logwriter.open_store(logFile, STREAMS['opto'])
             print("logFile opened")
-            self.logFile.write('time, LED Status\n')
 
     def stopLogging(self):
         with self.logLock:
@@ -0,0 +1,138 @@
+from collections import deque
+from threading import Lock, Condition
+
+from flyvr.service import Service
+
+class RingBuffer:
+    def __init__(self, capacity, on_drop=None):
+        # bounded FIFO: when full, the oldest item is dropped to make room
+        self.capacity = capacity
+        self.on_drop = on_drop
+        self.items = deque()
+        self.cond = Condition()
+
+        # number of items that have been queued but not yet marked done
+        self.pending = 0
+
+        # counters
+        self.puts = 0
+        self.drops = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.capacity:
+                dropped = self.items.popleft()
+                self.drops += 1
+                self.pending -= 1
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+            self.items.append(item)
+            self.puts += 1
+            self.pending += 1
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def task_done(self):
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        # block until every queued item has been processed (or dropped)
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending <= 0, timeout)
+
+    def clear(self):
+        with self.cond:
+            while self.items:
+                item = self.items.popleft()
+                self.pending -= 1
+                if self.on_drop is not None:
+                    self.on_drop(item)
+            self.cond.notify_all()
+
+    @property
+    def depth(self):
+        with self.cond:
+            return len(self.items)
+
+class PipelineStage(Service):
+    def __init__(self, name, func, capacity=2, on_drop=None, timeout=50e-3):
+        # name is used for reporting, func is called once per item
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+
+        # input queue for this stage
+        self.inbox = RingBuffer(capacity, on_drop=on_drop)
+
+        # number of items this stage has finished
+        self.processed = 0
+
+        # call constructor from parent
+        super().__init__()
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def flush(self, timeout=None):
+        return self.inbox.wait_idle(timeout)
+
+    # overriding method from parent...
+    def loopBody(self):
+        item = self.inbox.get(self.timeout)
+        if item is None:
+            return
+
+        try:
+            self.func(item)
+        finally:
+            self.processed += 1
+            self.inbox.task_done()
+
+    def cleanup(self):
+        # release anything still waiting so buffers are not leaked
+        self.inbox.clear()
+
+    def stats(self):
+        return {'depth': self.inbox.depth,
+                'capacity': self.inbox.capacity,
+                'drops': self.inbox.drops,
+                'processed': self.processed}
+
+class FramePool:
+    def __init__(self, size):
+        # reference counts for a fixed set of preallocated frame buffers
+        self.size = size
+        self.lock = Lock()
+        self.refs = [0]*size
+        self.free = deque(range(size))
+
+        # number of times no buffer was available
+        self.starved = 0
+
+    def acquire(self):
+        with self.lock:
+            if not self.free:
+                self.starved += 1
+                return None
+            index = self.free.popleft()
+            self.refs[index] = 1
+            return index
+
+    def retain(self, index):
+        with self.lock:
+            self.refs[index] += 1
+
+    def release(self, index):
+        with self.lock:
+            self.refs[index] -= 1
+            if self.refs[index] == 0:
+                self.free.append(index)
@@ -0,0 +1,56 @@
+from collections import namedtuple
+from threading import Condition
+
+# Immutable fly pose snapshot.  x, y (m) are the fly offset from the image
+# center and angle is the heading from the angle predictor; all three are
+# None when no fly was found in the frame.
+Pose = namedtuple('Pose', ['seq', 'frame_id', 'cam_time', 'host_time', 'x', 'y', 'angle', 'present'])
+
+class PoseBus:
+    # Single-writer, many-reader publication of pose snapshots.
+    #
+    # This follows the seqlock pattern: every snapshot carries a sequence
+    # number that the writer increments, and readers use it to tell whether
+    # a sample is new.  Because the whole snapshot is one immutable tuple,
+    # publishing it is a single reference store, which is atomic in CPython,
+    # so readers always see a consistent pose and never wait on a lock.
+    # Readers that want to sleep until the next pose can use wait_newer().
+
+    def __init__(self):
+        self.cond = Condition()
+        self.seq = 0
+        self._pose = Pose(seq=0, frame_id=None, cam_time=None, host_time=None,
+                          x=None, y=None, angle=None, present=False)
+
+    def publish(self, frame_id, cam_time, host_time, x, y, angle, present):
+        # only ever called from the thread that produces poses
+        self.seq += 1
+        self._pose = Pose(seq=self.seq, frame_id=frame_id, cam_time=cam_time, host_time=host_time,
+                          x=x, y=y, angle=angle, present=present)
+
+        # wake up anyone waiting for a new pose
+        with self.cond:
+            self.cond.notify_all()
+
+    def read(self):
+        # latest snapshot
+        return self._pose
+
+    def read_newer(self, seq):
+        # latest snapshot if it is newer than seq, otherwise None
+        pose = self._pose
+        if pose.seq > seq:
+            return pose
+        else:
+            return None
+
+    def wait_newer(self, seq, timeout=None):
+        # block until a snapshot newer than seq is published; None on timeout
+        pose = self.read_newer(seq)
+        if pose is not None:
+            return pose
+
+        with self.cond:
+            self.cond.wait_for(lambda: self._pose.seq > seq, timeout)
+
+        return self.read_newer(seq)
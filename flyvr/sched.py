@@ -0,0 +1,107 @@
+import gc
+import os
+import threading
+
+from flyvr.metrics import services, service_name
+
+# Scheduling profiles for services.  A profile is applied by the service's
+# own thread when its loop starts (see Service.loop), so CPU affinity, nice
+# value and real-time priority only affect that thread and the threads it
+# creates afterwards.  Anything the OS refuses (typically SCHED_FIFO or a
+# negative nice value without CAP_SYS_NICE) is skipped with a message, and
+# the service keeps running with the default scheduling.
+
+class SchedProfile:
+    def __init__(self, cpus=None, nice=None, fifo_priority=None, gc_policy=None):
+        # cpus: iterable of CPU numbers the thread may run on
+        # nice: nice value for the thread (-20 to 19)
+        # fifo_priority: SCHED_FIFO priority (1 to 99), or None for the normal scheduler
+        # gc_policy: None to leave the garbage collector alone, 'freeze' to move
+        # everything allocated so far out of the collected generations, or
+        # 'disable' to turn off automatic collection for the whole process
+        if gc_policy not in [None, 'freeze', 'disable']:
+            raise Exception('Invalid GC policy.')
+
+        self.cpus = sorted(cpus) if cpus is not None else None
+        self.nice = nice
+        self.fifo_priority = fifo_priority
+        self.gc_policy = gc_policy
+
+    def describe(self):
+        return {'cpus': self.cpus,
+                'nice': self.nice,
+                'fifo_priority': self.fifo_priority,
+                'gc_policy': self.gc_policy}
+
+    def apply(self):
+        # apply to the calling thread; returns what was and was not applied
+        applied = {}
+        errors = []
+
+        if self.cpus is not None:
+            try:
+                # only use the requested CPUs that this machine actually has
+                cpus = set(self.cpus) & os.sched_getaffinity(0)
+                if not cpus:
+                    raise OSError('none of CPUs {} are available'.format(self.cpus))
+                os.sched_setaffinity(0, cpus)
+                applied['cpus'] = sorted(cpus)
+            except (AttributeError, OSError) as e:
+                errors.append('cpus: {}'.format(e))
+
+        if self.nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+                applied['nice'] = self.nice
+            except (AttributeError, OSError) as e:
+                errors.append('nice: {}'.format(e))
+
+        if self.fifo_priority is not None:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.fifo_priority))
+                applied['fifo_priority'] = self.fifo_priority
+            except (AttributeError, OSError) as e:
+                errors.append('fifo_priority: {}'.format(e))
+
+        if self.gc_policy == 'freeze':
+            gc.collect()
+            gc.freeze()
+            applied['gc_policy'] = 'freeze'
+        elif self.gc_policy == 'disable':
+            gc.disable()
+            applied['gc_policy'] = 'disable'
+
+        return {'profile': self.describe(), 'applied': applied, 'errors': errors}
+
+# profiles looked up by service class name when none is given explicitly
+_profiles = {}
+
+def set_profile(name, profile):
+    _profiles[name] = profile
+
+def profile_for(service):
+    # the first profile registered for the service class or one of its bases
+    if isinstance(service, str):
+        return _profiles.get(service)
+    for cls in type(service).__mro__:
+        if cls.__name__ in _profiles:
+            return _profiles[cls.__name__]
+    return None
+
+def apply_profile(profile, name):
+    report = profile.apply()
+    for error in report['errors']:
+        print('{}: could not apply scheduling profile ({}), using defaults.'.format(name, error))
+    return report
+
+def report():
+    # scheduling actually in effect for every running service, for the metadata
+    result = {}
+    for service in services():
+        schedReport = getattr(service, 'schedReport', None)
+        if schedReport is not None:
+            result[service_name(service)] = schedReport
+        childReport = getattr(service, 'childSchedReport', None)
+        if childReport is not None:
+            result[service_name(service) + ' (child process)'] = childReport
+    return result
@@ -1,9 +1,15 @@
-from time import time, sleep
+from time import time, sleep, perf_counter
+from math import floor, sqrt
+from contextlib import contextmanager
 from warnings import warn
 from threading import Thread, Event
 
+from flyvr.metrics import LatencyHistogram, register
+from flyvr import sched
+
 class Service:
-    def __init__(self, minTime=None, maxTime=None, iter_warn=True):
+    def __init__(self, minTime=None, maxTime=None, iter_warn=True, spinTime=0, overrun='skip',
+                 warnInterval=1.0, profile=None):
         # set up minimum and maximum loop times
         self.minTime = minTime
         self.maxTime = maxTime
@@ -15,9 +21,48 @@ class Service:
             (self.maxTime < self.minTime)):
             raise Exception('Invalid loop time limits.')
 
+        # scheduler settings: when minTime is set, iterations start on a fixed
+        # grid of absolute deadlines.  The last spinTime seconds before a
+        # deadline are spent polling the clock instead of sleeping, which is
+        # more accurate than the OS sleep granularity.  When an iteration runs
+        # past its deadline, 'skip' drops the missed periods and waits for the
+        # next deadline on the grid, while 'catchup' runs the missed iterations
+        # back to back.
+        if overrun not in ['skip', 'catchup']:
+            raise Exception('Invalid overrun policy.')
+        self.spinTime = spinTime
+        self.overrun = overrun
+
+        # minimum time between slow iteration warnings
+        self.warnInterval = warnInterval
+
+        # scheduling profile (flyvr.sched.SchedProfile) for the loop thread;
+        # if None, a profile registered for the class name is used, if any
+        self.profile = profile
+        self.schedReport = None
+
+        # loop body time and period histograms
+        self.bodyHist = LatencyHistogram()
+        self.periodHist = LatencyHistogram()
+        self.iterCount = 0
+        self.overrunCount = 0
+        self.skippedCount = 0
+        self.slowCount = 0
+        self.jitterCount = 0
+        self.jitterMean = 0
+        self.jitterM2 = 0
+        self.jitterMax = 0
+
+        # time the current iteration has spent blocked in waiting(), which is
+        # left out of its measured body time
+        self.waitTime = 0
+
         # set up access to the thread-ending signal
         self.done = Event()
 
+        # make this service visible to flyvr.metrics.snapshot_all()
+        register(self)
+
     def start(self):
         self.thread = Thread(target=self.loop)
         self.thread.start()
@@ -33,34 +78,54 @@ class Service:
         pass
 
     def loop(self):
-        self.setup()
+        # apply the scheduling profile from the loop thread itself
+        profile = self.profile if self.profile is not None else sched.profile_for(self)
+        if profile is not None:
+            self.schedReport = sched.apply_profile(profile, self.__class__.__name__)
 
-        # initialize the loop iteration counter
-        self.iterCount = 0
+        self.setup()
 
         # record service starting time
         self.startTime = time()
 
         # main logic of loop control
-        loopStart = time()
+        deadline = perf_counter()
+        lastWarn = None
+        lastStart = None
         while not self.done.is_set():
             # run the loop body and measure how long it takes
+            loopStart = perf_counter()
+            if self.minTime is not None:
+                self.updateJitter(loopStart - deadline)
+            if lastStart is not None:
+                self.periodHist.record(loopStart - lastStart)
+            lastStart = loopStart
+
+            self.waitTime = 0
             self.loopBody()
-            loopStop = time()
-
-            # if the loop body finished too early, delay until
-            # the minimum loop time passes.  otherwise, if the loop
-            # time is too long, issue a warning
-
-            dt = loopStop - loopStart
-            loopStart = loopStop
-
-            if (self.minTime is not None) and (dt < self.minTime):
-                sleep(self.minTime - dt)
-
-            if (self.iter_warn) and (self.maxTime is not None) and (dt > self.maxTime):
-                #print('Slow iteration: {} ({:0.1f} ms)'.format(self.__class__.__name__, dt*1e3))
-                pass
+            loopStop = perf_counter()
+
+            # if the loop time is too long, issue a warning (at most
+            # once per warnInterval, reporting how many were slow)
+            dt = loopStop - loopStart - self.waitTime
+            self.bodyHist.record(dt)
+            if (self.maxTime is not None) and (dt > self.maxTime):
+                self.slowCount += 1
+                if self.iter_warn and (lastWarn is None or (loopStop - lastWarn) >= self.warnInterval):
+                    print('Slow iteration: {} ({:0.1f} ms, {} slow so far)'.format(
+                        self.__class__.__name__, dt*1e3, self.slowCount))
+                    lastWarn = loopStop
+
+            # if the loop body finished early, delay until the next deadline
+            if self.minTime is not None:
+                deadline += self.minTime
+                if loopStop > deadline:
+                    self.overrunCount += 1
+                    if self.overrun == 'skip':
+                        missed = floor((loopStop - deadline) / self.minTime) + 1
+                        deadline += missed * self.minTime
+                        self.skippedCount += missed
+                self.sleepUntil(deadline)
 
             # increment the loop iteration counter
             self.iterCount += 1
@@ -70,6 +135,56 @@ class Service:
 
         self.cleanup()
 
+    @contextmanager
+    def waiting(self):
+        # wrap sleeps and blocking reads in the loop body, so that only the
+        # work itself counts towards maxTime
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.waitTime += perf_counter() - start
+
+    def sleepUntil(self, deadline):
+        # sleep for most of the remaining time, then spin for the rest
+        remaining = deadline - perf_counter()
+        if remaining > self.spinTime:
+            sleep(remaining - self.spinTime)
+        while perf_counter() < deadline:
+            # yield the GIL while spinning
+            sleep(0)
+
+    def updateJitter(self, jitter):
+        # running mean / variance of how late each iteration started
+        self.jitterCount += 1
+        delta = jitter - self.jitterMean
+        self.jitterMean += delta / self.jitterCount
+        self.jitterM2 += delta * (jitter - self.jitterMean)
+        self.jitterMax = max(self.jitterMax, jitter)
+
+    def jitterStats(self):
+        if self.jitterCount > 1:
+            std = sqrt(self.jitterM2 / (self.jitterCount - 1))
+        else:
+            std = None
+
+        return {'count': self.jitterCount,
+                'mean': self.jitterMean,
+                'std': std,
+                'max': self.jitterMax,
+                'overruns': self.overrunCount,
+                'skipped': self.skippedCount}
+
+    def metrics(self):
+        # snapshot of loop statistics, safe to call from any thread
+        return {'iterations': self.iterCount,
+                'body': self.bodyHist.snapshot(),
+                'period': self.periodHist.snapshot(),
+                'slow': self.slowCount,
+                'overruns': self.overrunCount,
+                'skipped': self.skippedCount,
+                'jitter': self.jitterStats()}
+
     @property
     def avePeriod(self):
         return (self.stopTime - self.startTime) / self.iterCount
@@ -0,0 +1,226 @@
+import cv2
+import numpy as np
+
+from math import pi, cos, sin
+from time import perf_counter, sleep, time
+
+from flyvr.video import open_video
+
+# Frame sources used by flyvr.camera.Camera.  Every source has the same
+# interface: grab_width / grab_height, grab(grayFrame) to fill a preallocated
+# uint8 buffer with the next frame and return its FrameInfo (or None once
+# the source has run out of frames), is_grabbing() and close().
+
+class FrameInfo:
+    def __init__(self, frame_id, cam_time, host_time):
+        # frame counter and timestamp (s) reported by the camera, and the
+        # host time at which the frame was received
+        self.frame_id = frame_id
+        self.cam_time = cam_time
+        self.host_time = host_time
+
+        # filled in by Camera / CamThread
+        self.dropped = 0
+        self.latency = None
+
+class PylonSource:
+    def __init__(self, grab_mode='mono8', tick_period=1e-9):
+        # imported here so that the other sources work without pypylon installed
+        from pypylon import pylon
+        self.pylon = pylon
+
+        # Open the capture stream
+        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+
+        # Ask the camera for Mono8 directly so that no color conversion is needed
+        self.grab_mode = grab_mode
+        if self.grab_mode == 'mono8':
+            self.camera.Open()
+            try:
+                self.camera.PixelFormat.SetValue('Mono8')
+            except:
+                print('Camera does not support Mono8, falling back to BGR8 conversion.')
+                self.grab_mode = 'bgr8'
+        elif self.grab_mode != 'bgr8':
+            raise Exception('Invalid grab mode.')
+
+        # Camera timestamp units (ns on USB3 cameras)
+        self.tick_period = tick_period
+
+        self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+
+        # Grab a dummy frame to get the width and height
+        grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+        self.grab_width = int(grabResult.Width)
+        self.grab_height = int(grabResult.Height)
+        grabResult.Release()
+        print('Camera grab dimensions: ({}, {})'.format(self.grab_width, self.grab_height))
+
+        # Set up image converter (only used in BGR8 mode)
+        self.converter = pylon.ImageFormatConverter()
+        self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+        self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+
+    def grab(self, grayFrame):
+        # Capture a single frame into the given grayscale buffer
+        grabResult = self.camera.RetrieveResult(5000, self.pylon.TimeoutHandling_ThrowException)
+        try:
+            # the block ID is counted by the camera, so gaps reveal dropped frames
+            info = FrameInfo(frame_id=grabResult.BlockID,
+                             cam_time=grabResult.TimeStamp*self.tick_period,
+                             host_time=time())
+
+            if self.grab_mode == 'mono8':
+                # wrap the grab buffer without copying it
+                with grabResult.GetArrayZeroCopy() as grabArray:
+                    np.copyto(grayFrame, grabArray)
+            else:
+                image = self.converter.Convert(grabResult)
+                cv2.cvtColor(image.GetArray(), cv2.COLOR_BGR2GRAY, dst=grayFrame)
+        finally:
+            grabResult.Release()
+
+        return info
+
+    def is_grabbing(self):
+        return self.camera.IsGrabbing()
+
+    def close(self):
+        self.camera.StopGrabbing()
+
+class VideoSource:
+    def __init__(self, path, realtime=True, fps=124.2, loop=True):
+        # Replays a recorded trial video (e.g. cam_compr.mjpeg or cam_compr.mkv).
+        # With realtime=True frames are paced at the recorded rate, otherwise
+        # they are returned as fast as they can be decoded.
+        self.video = open_video(path)
+        self.num_frames = len(self.video)
+        if self.num_frames == 0:
+            raise Exception('Video file {} has no frames.'.format(path))
+
+        # use the container frame rate if there is one
+        self.fps = getattr(self.video, 'fps', None) or fps
+        self.realtime = realtime
+        self.loop = loop
+
+        frame = self.video.read(0)
+        self.grab_height, self.grab_width = frame.shape
+        print('Video grab dimensions: ({}, {})'.format(self.grab_width, self.grab_height))
+
+        # position in the video, and frames grabbed so far; the frame id and
+        # camera time keep counting up when the video starts over
+        self.index = 0
+        self.frameCount = 0
+        self.grabbing = True
+        self.startTime = None
+
+    def grab(self, grayFrame):
+        if not self.grabbing:
+            return None
+
+        if self.index >= self.num_frames:
+            if not self.loop:
+                # end of the video: stop grabbing
+                self.grabbing = False
+                return None
+            self.index = 0
+
+        # pace frames at the recorded rate
+        if self.realtime:
+            if self.startTime is None:
+                self.startTime = perf_counter()
+            delay = self.startTime + self.frameCount/self.fps - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+        np.copyto(grayFrame, self.video.read(self.index))
+        info = FrameInfo(frame_id=self.frameCount, cam_time=self.frameCount/self.fps, host_time=time())
+        self.index += 1
+        self.frameCount += 1
+
+        return info
+
+    def is_grabbing(self):
+        return self.grabbing
+
+    def close(self):
+        self.grabbing = False
+        self.video.close()
+
+class SyntheticSource:
+    def __init__(self, width=1280, height=1024, fps=124.2, realtime=True,
+                 px_per_m=37023.1016957, speed=0.02, turn_rate=2*pi, radius=5e-3,
+                 body_length=2.5e-3, body_width=1e-3, background=200, foreground=40,
+                 noise=8, seed=None):
+        # Generates frames of a dark ellipse ("fly") walking over a bright,
+        # noisy background.  The fly moves at the given speed (m/s), turns
+        # randomly, and is steered back when it is more than radius (m) away
+        # from the image center.  The true pose is kept in self.truth.
+        self.grab_width = width
+        self.grab_height = height
+        self.fps = fps
+        self.realtime = realtime
+
+        self.px_per_m = px_per_m
+        self.speed = speed
+        self.turn_rate = turn_rate
+        self.radius = radius
+        self.axes = (max(int(round(0.5*body_length*px_per_m)), 1),
+                     max(int(round(0.5*body_width*px_per_m)), 1))
+        self.foreground = foreground
+
+        # static noisy background that is copied into every frame
+        self.rng = np.random.default_rng(seed)
+        noise_frame = self.rng.normal(0, noise, (height, width))
+        self.background = np.clip(background + noise_frame, 0, 255).astype(np.uint8)
+
+        # fly state, in meters relative to the image center
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = self.rng.uniform(0, 2*pi)
+        self.truth = None
+
+        self.index = 0
+        self.grabbing = True
+        self.startTime = None
+
+    def step(self, dt):
+        # random turning, plus steering back toward the center when too far out
+        self.heading += self.rng.normal(0, self.turn_rate*np.sqrt(dt))
+        if self.x*self.x + self.y*self.y > self.radius*self.radius:
+            self.heading = np.arctan2(-self.y, -self.x)
+
+        self.x += self.speed*cos(self.heading)*dt
+        self.y += self.speed*sin(self.heading)*dt
+
+    def grab(self, grayFrame):
+        # pace frames at the nominal frame rate
+        if self.realtime:
+            if self.startTime is None:
+                self.startTime = perf_counter()
+            delay = self.startTime + self.index/self.fps - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+        self.step(1/self.fps)
+
+        # image coordinates (y axis pointing down)
+        cx = self.grab_width/2.0 + self.x*self.px_per_m
+        cy = self.grab_height/2.0 - self.y*self.px_per_m
+        angle = -np.degrees(self.heading)
+
+        np.copyto(grayFrame, self.background)
+        cv2.ellipse(grayFrame, (int(round(cx)), int(round(cy))), self.axes, angle, 0, 360,
+                    self.foreground, -1)
+
+        self.truth = (cx, cy, self.heading)
+        info = FrameInfo(frame_id=self.index, cam_time=self.index/self.fps, host_time=time())
+        self.index += 1
+
+        return info
+
+    def is_grabbing(self):
+        return self.grabbing
+
+    def close(self):
+        self.grabbing = False
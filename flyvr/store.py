@@ -0,0 +1,202 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Binary trial data store.  Every stream (cam, cnc, temp, opto, video) is written to
+# its own file, <stream>.bin, with typed columns that are filled in
+# preallocated buffers and written out a block of rows at a time, so the
+# service loops never format text, and analysis reads whole columns straight
+# into NumPy arrays.
+#
+# File layout (all integers little-endian):
+#     8 bytes   magic, b'FLYVRST1'
+#     uint32    length of the JSON header
+#     ...       JSON header: {"stream": name, "columns": [[name, dtype], ...]}
+#               where a column with fixed-size array values (e.g. a line-scan
+#               frame) is [name, dtype, shape]
+#     chunks until the end of the file, each one
+#         uint32    number of rows n
+#         ...       for each column in order, n values of its dtype (and shape)
+# Chunks can have any size; a chunk cut short by a crash is ignored.
+#
+# Inspect or convert a file from the command line:
+#     python -m flyvr.store <file.bin | trial_dir> [--csv]
+
+MAGIC = b'FLYVRST1'
+COUNT = struct.Struct('<I')
+
+# opto event codes
+OPTO_LED = 0
+OPTO_FOOD = 1
+OPTO_FOOD_REMOVED = 2
+
+STREAMS = {
+    # pose of the fly in each frame where it was found; roi is True when the
+    # fly was found by the ROI search, False for a full-frame search
+    'cam': [('t', '<f8'), ('x', '<f8'), ('y', '<f8'), ('angle', '<f8'), ('roi', '|b1'),
+            ('frame', '<i8'), ('cam_t', '<f8'), ('latency', '<f8'), ('dropped', '<i8')],
+    # gantry position from each status report
+    'cnc': [('t', '<f8'), ('x', '<f8'), ('y', '<f8')],
+    # arena temperature and humidity
+    'temp': [('t', '<f8'), ('temp', '<f4'), ('humd', '<f4')],
+    # LED changes and food spots; unused fields are -1 / NaN
+    'opto': [('t', '<f8'), ('event', '|u1'), ('led', '|i1'), ('x', '<f8'), ('y', '<f8')],
+    # one row per frame in the trial video: its position in the video, its
+    # byte offset and size in the file (-1 for container formats), the
+    # camera frame it came from, and its row in the cam stream (-1 when no
+    # fly was found in it)
+    'video': [('frame', '<i8'), ('offset', '<i8'), ('size', '<i8'), ('frame_id', '<i8'),
+              ('cam_t', '<f8'), ('host_t', '<f8'), ('pose_row', '<i8')]
+}
+
+def to_float(value):
+    # NaN for missing or unparseable values
+    try:
+        return np.nan if value is None else float(value)
+    except ValueError:
+        return np.nan
+
+def to_int(value):
+    return -1 if value is None else value
+
+def parse_columns(columns):
+    # names, dtypes and value shapes of (name, dtype) or (name, dtype, shape) columns
+    names = [column[0] for column in columns]
+    dtypes = [np.dtype(column[1]) for column in columns]
+    shapes = [tuple(column[2]) if len(column) > 2 else () for column in columns]
+    return names, dtypes, shapes
+
+class StoreWriter:
+    def __init__(self, path, columns, chunk_rows=4096):
+        self.path = path
+        self.names, self.dtypes, self.shapes = parse_columns(columns)
+        self.chunk_rows = chunk_rows
+
+        # preallocated column buffers for the chunk being filled
+        self.buffers = [np.zeros((chunk_rows,) + shape, dtype=dtype)
+                        for dtype, shape in zip(self.dtypes, self.shapes)]
+        self.rows = 0
+        self.total = 0
+
+        header = [[name, dtype.str] + ([list(shape)] if shape else [])
+                  for name, dtype, shape in zip(self.names, self.dtypes, self.shapes)]
+        header = json.dumps({'stream': os.path.splitext(os.path.basename(path))[0],
+                             'columns': header})
+        header = header.encode('utf-8')
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + COUNT.pack(len(header)) + header)
+
+    def append(self, *row):
+        # one row, in column order
+        n = self.rows
+        for buffer, value in zip(self.buffers, row):
+            buffer[n] = value
+        self.rows = n + 1
+        if self.rows == self.chunk_rows:
+            self.writeChunk()
+
+    def writeChunk(self):
+        n = self.rows
+        if n == 0:
+            return
+        self.file.write(COUNT.pack(n))
+        for buffer in self.buffers:
+            self.file.write(buffer[:n].tobytes())
+        self.total += n
+        self.rows = 0
+
+    def flush(self):
+        # write out the rows collected so far
+        self.writeChunk()
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.writeChunk()
+        self.file.close()
+
+def read_header(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise Exception('Not a trial data store file.')
+    offset = len(MAGIC)
+    length, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    header = json.loads(bytes(data[offset:offset+length]).decode('utf-8'))
+    return header, offset + length
+
+def read_stream(path):
+    # dict of column name -> array, plus the header under '_header'
+    with open(path, 'rb') as f:
+        data = f.read()
+    header, offset = read_header(data)
+    names, dtypes, shapes = parse_columns(header['columns'])
+    sizes = [int(np.prod(shape, dtype=np.int64)) for shape in shapes]
+    rowSize = sum(dtype.itemsize*size for dtype, size in zip(dtypes, sizes))
+
+    parts = [[] for _ in names]
+    while offset + COUNT.size <= len(data):
+        n, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        if offset + n*rowSize > len(data):
+            break
+        for part, dtype, shape, size in zip(parts, dtypes, shapes, sizes):
+            part.append(np.frombuffer(data, dtype=dtype, count=n*size, offset=offset).reshape((n,) + shape))
+            offset += n*size*dtype.itemsize
+
+    result = {'_header': header}
+    for name, dtype, shape, part in zip(names, dtypes, shapes, parts):
+        result[name] = np.concatenate(part) if part else np.zeros((0,) + shape, dtype=dtype)
+    return result
+
+def read_trial(trial_dir):
+    # every stream in the trial directory, by stream name
+    result = {}
+    for fname in sorted(os.listdir(trial_dir)):
+        if fname.endswith('.bin'):
+            path = os.path.join(trial_dir, fname)
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    continue
+            result[os.path.splitext(fname)[0]] = read_stream(path)
+    return result
+
+def write_csv(stream, out):
+    # array values are written as their elements separated by spaces
+    names = [column[0] for column in stream['_header']['columns']]
+    out.write(','.join(names) + '\n')
+    columns = [stream[name] for name in names]
+    for row in zip(*columns):
+        out.write(','.join(' '.join(str(v) for v in value.flat) if np.ndim(value) > 0 else str(value)
+                           for value in row) + '\n')
+
+def describe(name, stream):
+    names = [column[0] for column in stream['_header']['columns']]
+    rows = len(stream[names[0]]) if names else 0
+    return '{}: {} rows, columns {}'.format(name, rows, ', '.join(names))
+
+def main():
+    # usage: python -m flyvr.store <file.bin | trial_dir> [--csv]
+    if len(sys.argv) < 2:
+        print('usage: python -m flyvr.store <file.bin | trial_dir> [--csv]')
+        return
+
+    path = sys.argv[1]
+    if os.path.isdir(path):
+        streams = read_trial(path)
+    else:
+        streams = {os.path.splitext(os.path.basename(path))[0]: read_stream(path)}
+
+    if '--csv' in sys.argv[2:]:
+        for stream in streams.values():
+            write_csv(stream, sys.stdout)
+    else:
+        for name, stream in streams.items():
+            print(describe(name, stream))
+
+if __name__ == '__main__':
+    main()
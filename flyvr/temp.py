@@ -5,6 +5,8 @@ from time import time, sleep
 
 from flyvr.util import serial_number_to_comport
 from flyvr.service import Service
+from flyvr.store import STREAMS, to_float
+from flyvr import logwriter
 
 class TempMonitor(Service):
     def __init__(self, maxTime=12e-3):
@@ -59,21 +61,20 @@ class TempMonitor(Service):
 
     def loopBody(self):
         # read temp
-        self.read_temp()
+        with self.waiting():
+            raw_data = self.conn.readline()
+        self.read_temp(raw_data)
 
         # write logs
         with self.logLock:
             if self.logState:
-                #logStr = 'tada'
-                logStr = (str(time()) + ',' +
-                          str(self.temp) + ',' +
-                          str(self.humd) + '\n')
-                self.logFile.write(logStr)
+                self.logFile.append(time(), to_float(self.temp), to_float(self.humd))
 
-        sleep(1)
+        with self.waiting():
+            sleep(1)
 
-    def read_temp(self):
-        raw_data = str(self.conn.readline())
+    def read_temp(self, raw_data):
+        raw_data = str(raw_data)
         parts = raw_data.split(',')
         self.temp = parts[1].strip()
         self.humd = parts[2].strip()
@@ -88,8 +89,7 @@ class TempMonitor(Service):
                 self.logFile.close()
 
             # open new log file
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,temp,humd\n')
+            self.logFile = logwriter.open_store(logFile, STREAMS['temp'])
 
     def stopLogging(self):
         with self.logLock:
@@ -0,0 +1,110 @@
+import itertools
+import numpy as np
+
+from time import time
+
+# Hops that a camera frame goes through on its way to the stepper motors.
+# Every hop is recorded with the frame id (the camera frame counter) and the
+# host time() at which it happened.
+GRAB = 0      # frame received from the camera
+DETECT = 1    # pose published by CamThread
+TRACK = 2     # pose picked up by TrackThread
+COMMAND = 3   # velocity handed to CncThread
+SEND = 4      # velocity command written to the serial port
+STATUS = 5    # status report received from the Arduino
+
+STAGES = ['grab', 'detect', 'track', 'command', 'send', 'status']
+
+EVENT_DTYPE = np.dtype([('frame_id', '<i8'), ('stage', '<i1'), ('t', '<f8')])
+
+class Tracer:
+    # Fixed-size ring of trace events shared by all threads.  Writers claim a
+    # slot with next() on an itertools.count, which is atomic in CPython, so
+    # recording an event takes no lock and never allocates.
+
+    def __init__(self, capacity=1 << 18):
+        self.capacity = capacity
+        self.events = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.events['frame_id'] = -1
+        self.counter = itertools.count()
+        self.enabled = True
+
+    def record(self, frame_id, stage, t=None):
+        if not self.enabled or frame_id is None:
+            return
+
+        index = next(self.counter) % self.capacity
+        event = self.events[index]
+        event['frame_id'] = frame_id
+        event['stage'] = stage
+        event['t'] = time() if t is None else t
+
+    def snapshot(self, since=None):
+        # copy of the recorded events in time order, optionally only those after since
+        events = self.events[self.events['frame_id'] >= 0].copy()
+        if since is not None:
+            events = events[events['t'] >= since]
+        return np.sort(events, order='t')
+
+    def clear(self):
+        self.events['frame_id'] = -1
+
+def hop_latencies(events):
+    # time from one stage to the next for every frame that went through both,
+    # plus the end-to-end time from grab to each later stage
+    first = {}
+    for stage in range(len(STAGES)):
+        sel = events[events['stage'] == stage]
+
+        # only the first time a frame reached a stage counts
+        ids, index = np.unique(sel['frame_id'], return_index=True)
+        first[stage] = (ids, sel['t'][index])
+
+    def between(a, b):
+        ids_a, t_a = first[a]
+        ids_b, t_b = first[b]
+        common, ia, ib = np.intersect1d(ids_a, ids_b, return_indices=True)
+        return t_b[ib] - t_a[ia]
+
+    latencies = {}
+    for stage in range(1, len(STAGES)):
+        latencies[STAGES[stage-1] + '->' + STAGES[stage]] = between(stage-1, stage)
+    for stage in range(2, len(STAGES)):
+        latencies[STAGES[GRAB] + '->' + STAGES[stage]] = between(GRAB, stage)
+
+    return latencies
+
+def summarize(events):
+    # latency distribution (s) of every hop
+    summary = {}
+    for hop, values in hop_latencies(events).items():
+        if len(values) == 0:
+            summary[hop] = {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+        else:
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            summary[hop] = {'count': len(values), 'mean': float(np.mean(values)),
+                            'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                            'max': float(np.max(values))}
+    return summary
+
+def dump(tracer, prefix, since=None):
+    # save the raw events (prefix.npy) and the per-hop summary (prefix.txt)
+    events = tracer.snapshot(since=since)
+    np.save(prefix + '.npy', events)
+
+    summary = summarize(events)
+    with open(prefix + '.txt', 'w') as f:
+        f.write('hop,count,mean,p50,p90,p99,max\n')
+        for hop, s in summary.items():
+            f.write(','.join([hop] + [str(s[key]) for key in ['count', 'mean', 'p50', 'p90', 'p99', 'max']]) + '\n')
+
+    return summary
+
+def load(prefix):
+    return np.load(prefix + '.npy')
+
+# default tracer used by the camera, tracker and CNC services
+tracer = Tracer()
+
+def record(frame_id, stage, t=None):
+    tracer.record(frame_id, stage, t)
@@ -5,6 +5,9 @@ from numpy import sign
 
 from flyvr.service import Service
 from flyvr.cnc import cnc_home, CncThread
+from flyvr import trace
+from flyvr.motion import MoveProfile
+from flyvr.estimator import FlyEstimator
 
 class TrackThread(Service):
     def __init__(self,
@@ -20,7 +23,18 @@ class TrackThread(Service):
 
                  center_pos_x = 0.348625,
                  center_pos_y = 0.332775,
-                 manual_pos_tol= 1e-3
+                 manual_pos_tol= 1e-3,
+
+                 move_profile = 'scurve', # 'trapezoid' or 'scurve' point-to-point moves
+                 move_max_vel = 0.5, # m/s, peak speed of point-to-point moves
+                 move_max_acc = 0.8, # m/s^2, peak acceleration of point-to-point moves
+
+                 event_driven = True, # wake up on each new camera pose instead of polling
+
+                 use_estimator = True, # track the fly position predicted by a FlyEstimator
+                 lead_time = 5e-3, # s, how far ahead of now a command takes effect
+                 cam_delay = 0, # s, from frame capture to Pose.host_time
+                 cnc_device = None # stand-in for the gantry, e.g. flyvr.virtual_cnc.VirtualStepper
                  ):
 
         # Store thread handles
@@ -30,6 +44,7 @@ class TrackThread(Service):
         self.cncThreadLock = Lock()
         self._cncThread = None
 
+        self.cnc_device = cnc_device
         self.cnc_shouldinitialize = Event()
         self.is_init = False
 
@@ -60,6 +75,22 @@ class TrackThread(Service):
         self.center_pos_y = center_pos_y
         self.manual_pos_tol = manual_pos_tol
 
+        # Point-to-point moves follow a planned profile, with proportional
+        # feedback (k_pctrl, at most v_max_ctrl) on top to correct for errors
+        self.move_profile = move_profile
+        self.move_max_vel = move_max_vel
+        self.move_max_acc = move_max_acc
+        self.move = None
+        self.moveTarget = None
+        self.moveStart = None
+        self.lastMoveTime = None
+
+        # Fly position estimate, fused from camera poses and CNC status; the
+        # controller acts on the offset predicted lead_time ahead
+        self.estimator = FlyEstimator() if use_estimator else None
+        self.lead_time = lead_time
+        self.cam_delay = cam_delay
+
         # Initialize the control loop
         self.prevVelX = 0
         self.prevVelY = 0
@@ -69,9 +100,25 @@ class TrackThread(Service):
 
         # Set manual jog velocity
         self.manual_jog_vel = 0.02
-                 
-        # call constructor from parent        
-        super().__init__(minTime=loopTime, maxTime=loopTime, iter_warn=False)
+
+        # Event-driven mode: block until the camera publishes a new pose, with
+        # loopTime as a timeout so that manual moves keep being serviced
+        self.event_driven = event_driven
+        self.loopTime = loopTime
+        self.poseBus = None
+        self.lastPoseSeq = 0
+
+        # Camera-to-command latency statistics
+        self.latencyCount = 0
+        self.latencySum = 0
+        self.latencyMax = 0
+        self.lastLatency = None
+
+        # call constructor from parent
+        if self.event_driven:
+            super().__init__(maxTime=loopTime, iter_warn=False)
+        else:
+            super().__init__(minTime=loopTime, maxTime=loopTime, iter_warn=False)
 
     @property
     def camThread(self):
@@ -101,11 +148,11 @@ class TrackThread(Service):
                 self.cncThread.stop()
 
             print('Homing CNC...')
-            cnc_home()
+            cnc_home(maxAcc=self.maxAbsAcc, device=self.cnc_device)
             print('Done homing CNC.')
 
             print('Creating a new cncThread...')
-            self.cncThread = CncThread()
+            self.cncThread = CncThread(device=self.cnc_device)
             self.cncThread.start()
 
             print('Starting to move to center...')
@@ -115,36 +162,26 @@ class TrackThread(Service):
             self.cnc_shouldinitialize.clear()
         if self.cncThread is None:
             print('Creating a cncThread since none exists.')
-            self.cncThread = CncThread()
+            self.cncThread = CncThread(device=self.cnc_device)
             self.cncThread.start()
 
+        # get latest camera data
+        pose = self.getPose()
+        newPose = pose is not None and pose.seq > self.lastPoseSeq
+        if newPose:
+            trace.record(pose.frame_id, trace.TRACK)
+            self.updateEstimate(pose)
+
         #print('cnc: ', self.cncThread)
         #print('cam: ', self.camThread)
         # read current time
         thisTime = time()
         dt = thisTime - self.lastTime
 
-        #get latest camera data
-        try:
-            flyData = self.camThread.flyData
-        except:
-            flyData = None
-
-        # store fly position information
-        if flyData is not None:
-            flyX = flyData.flyX
-            flyY = flyData.flyY
-            flyPresent = flyData.flyPresent
-        else:
-            flyX = 0
-            flyY = 0
-            flyPresent = False
-
-        # Switching to vrcam
-        if self.camThread is not None and self.camThread.fly is not None:
-            flyX = self.camThread.fly.centerX
-            flyY = self.camThread.fly.centerY
-            flyPresent = True
+        if pose is not None:
+            flyX = pose.x
+            flyY = pose.y
+            flyPresent = pose.present
         else:
             flyX = 0
             flyY = 0
@@ -158,25 +195,16 @@ class TrackThread(Service):
         velY = 0
 
         if manualPosition is not None:
-            if self.is_close_to_pos(self.manualPosition.posX, self.manualPosition.posY):
-                print('Got to specified manual position.')
-                self.manualPosition = None
-            else:
-                cncStatus = self.cncThread.status
-                try:
-                    velX = self.k_pctrl*(manualPosition.posX - cncStatus.posX)
-                    velY = self.k_pctrl*(manualPosition.posY - cncStatus.posY)
-                except:
-                    print('Problem setting velocity for manual position control.')
-
-                if abs(velX) > self.v_max_pctrl:
-                    velX = float(sign(velX)*self.v_max_pctrl)
-                if abs(velY) > self.v_max_pctrl:
-                    velY = float(sign(velY)*self.v_max_pctrl)
+            velX, velY = self.updateFromMove(manualPosition, thisTime)
         elif manualVelocity is not None:
             velX = manualVelocity.velX
             velY = manualVelocity.velY
         elif self.trackingEnabled and flyPresent:
+            # act on where the fly will be relative to the gantry, if known
+            predicted = self.predictOffset(thisTime)
+            if predicted is not None:
+                flyX, flyY = predicted
+
             # update velocities from fly position
             velX = self.updateFromFlyPos(flyX)
             velY = self.updateFromFlyPos(flyY)
@@ -189,14 +217,124 @@ class TrackThread(Service):
         velX = self.updateFromMaxAcc(velX, self.prevVelX, dt)
         velY = self.updateFromMaxAcc(velY, self.prevVelY, dt)
 
-        # update CNC velocity
-        self.cncThread.setVel(velX, velY)
+        # update CNC velocity, tagged with the frame it was computed from
+        self.cncThread.setVel(velX, velY, frame_id=pose.frame_id if newPose else None)
+
+        # measure the latency from camera frame to command
+        if newPose and pose.host_time is not None:
+            self.updateLatency(time() - pose.host_time)
+        if pose is not None:
+            self.lastPoseSeq = pose.seq
 
         # save history variables
         self.lastTime = thisTime
         self.prevVelX = velX
         self.prevVelY = velY
 
+    def updateFromMove(self, target, thisTime):
+        cncStatus = self.cncThread.status
+        if cncStatus is None:
+            return 0, 0
+
+        # plan a new move when the target changes
+        if self.moveTarget is not target:
+            self.move = MoveProfile(cncStatus.posX, cncStatus.posY, target.posX, target.posY,
+                                    maxVel=self.move_max_vel, maxAcc=self.move_max_acc,
+                                    kind=self.move_profile)
+            self.moveTarget = target
+            self.moveStart = thisTime
+
+        t = thisTime - self.moveStart
+        if t >= self.move.duration and self.is_close_to_pos(target.posX, target.posY):
+            self.lastMoveTime = t
+            print('Got to specified manual position in {:0.2f} s.'.format(t))
+            self.manualPosition = None
+            self.move = None
+            self.moveTarget = None
+            return 0, 0
+
+        # follow the profile, correcting for any error in where the gantry is
+        posX, posY, velX, velY = self.move.sample(t)
+        velX += self.clampCorrection(self.k_pctrl*(posX - cncStatus.posX))
+        velY += self.clampCorrection(self.k_pctrl*(posY - cncStatus.posY))
+
+        return velX, velY
+
+    def updateEstimate(self, pose):
+        if self.estimator is None:
+            return
+        if not pose.present or pose.host_time is None or self.cncThread is None:
+            self.estimator.reset()
+            return
+
+        # the fly's arena position is the camera offset plus the gantry position at capture
+        t = pose.host_time - self.cam_delay
+        cncPos = self.cncThread.history.interpolate(t)
+        if cncPos is None:
+            return
+        self.estimator.update(t, pose.x + cncPos[0], pose.y + cncPos[1])
+
+    def predictOffset(self, thisTime):
+        # fly offset from the gantry when the next command takes effect, or None
+        if self.estimator is None or self.cncThread is None:
+            return None
+        t = thisTime + self.lead_time
+        fly = self.estimator.predict(t)
+        latest = self.cncThread.history.latest()
+        if fly is None or latest is None:
+            return None
+
+        # the gantry keeps moving at the last commanded velocity until then
+        statusTime, cncX, cncY = latest
+        cncX += self.prevVelX*(t - statusTime)
+        cncY += self.prevVelY*(t - statusTime)
+        return fly[0] - cncX, fly[1] - cncY
+
+    def clampCorrection(self, vel):
+        if abs(vel) > self.v_max_pctrl:
+            return float(sign(vel)*self.v_max_pctrl)
+        else:
+            return vel
+
+    def getPose(self):
+        camThread = self.camThread
+        if camThread is None:
+            if self.event_driven:
+                # nothing to wait on, so avoid spinning
+                with self.waiting():
+                    sleep(self.loopTime)
+            return None
+
+        # sequence numbers restart if the camera thread is replaced
+        if camThread.poseBus is not self.poseBus:
+            self.poseBus = camThread.poseBus
+            self.lastPoseSeq = 0
+
+        if self.event_driven:
+            with self.waiting():
+                pose = self.poseBus.wait_newer(self.lastPoseSeq, timeout=self.loopTime)
+            if pose is not None:
+                return pose
+
+        return camThread.pose
+
+    def updateLatency(self, latency):
+        self.latencyCount += 1
+        self.latencySum += latency
+        self.latencyMax = max(self.latencyMax, latency)
+        self.lastLatency = latency
+
+    def latencyStats(self):
+        return {'latency_last': self.lastLatency,
+                'latency_mean': self.latencySum/self.latencyCount if self.latencyCount > 0 else None,
+                'latency_max': self.latencyMax}
+
+    def metrics(self):
+        metrics = super().metrics()
+        if self.estimator is not None:
+            metrics['estimator'] = self.estimator.stats()
+        return metrics
+
     # For gui control
     def manual_move_up(self):
         self.manualVelocity = ManualVelocity(velX=0, velY= +self.manual_jog_vel)
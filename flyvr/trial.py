@@ -7,6 +7,9 @@ import itertools
 from time import strftime, time, sleep
 
 from flyvr.service import Service
+from flyvr.metrics import MetricsDumper, write_snapshot
+from flyvr import trace
+from flyvr import logwriter
 from threading import Lock
 from flyvr.tracker import TrackThread, ManualVelocity
 
@@ -63,6 +66,10 @@ class TrialThread(Service):
         if self.dispenser is not None:
             self.dispenser.start_logging(self.exp_dir)
 
+        # keep a live snapshot of service metrics for "python -m flyvr.metrics"
+        # (started with the loop in setup(), stopped in cleanup())
+        self.metricsDumper = MetricsDumper(os.path.join(self.exp_dir, 'metrics.json'))
+
         # call constructor from parent
         super().__init__(minTime=loopTime, maxTime=loopTime, iter_warn=False)
 
@@ -81,12 +88,12 @@ class TrialThread(Service):
         self._trial_dir = _trial_dir
         os.makedirs(_trial_dir)
 
-        self.tracker.startLogging(os.path.join(_trial_dir, 'cnc.txt'))
-        self.cam.startLogging(os.path.join(_trial_dir, 'cam.txt'), os.path.join(_trial_dir, 'cam_compr.mkv'))
-        self.temp.startLogging(os.path.join(_trial_dir, 'temp.txt'))
+        self.tracker.startLogging(os.path.join(_trial_dir, 'cnc.bin'))
+        self.cam.startLogging(os.path.join(_trial_dir, 'cam.bin'), os.path.join(_trial_dir, self.cam.video_name))
+        self.temp.startLogging(os.path.join(_trial_dir, 'temp.bin'))
 
         if self.opto is not None:
-            self.opto.startLogging(os.path.join(_trial_dir, 'opto.txt'))
+            self.opto.startLogging(os.path.join(_trial_dir, 'opto.bin'))
             self.opto.trial_start_t = self.trial_start_t
 
 
@@ -124,9 +131,22 @@ class TrialThread(Service):
     def _stop_trial(self):
         print('Stopped trial.')
 
+        # stop every logging service before the flush, so that their final
+        # rows and closes are queued ahead of it
         self.tracker.stopLogging()
         self.cam.stopLogging()
         self.temp.stopLogging()
+        if self.opto is not None:
+            self.opto.stopLogging()
+
+        # wait for the background log writer to finish the trial's logs
+        if not logwriter.flush():
+            print('Log writer did not finish flushing the trial logs.')
+
+        # save the service metrics and the frame latency trace at the end of the trial
+        if self._trial_dir is not None:
+            write_snapshot(os.path.join(self._trial_dir, 'metrics.json'))
+            trace.dump(trace.tracer, os.path.join(self._trial_dir, 'trace'), since=self.trial_start_t)
 
         self.tracker.stopTracking()
         self.trial_start_t = None
@@ -134,7 +154,6 @@ class TrialThread(Service):
 
         if self.opto is not None:
             self.opto.trial_start_t = self.trial_start_t
-            self.opto.stopLogging()
             self.opto.foodspots = []
             self.opto.closest_food = None
             self.opto.fly_in_food = False
@@ -162,9 +181,10 @@ class TrialThread(Service):
     def get_fly_pos(self):
         ### Get Fly Position ###
 
-        if self.cam is not None and self.cam.fly is not None:
-            camX = self.cam.fly.centerX
-            camY = self.cam.fly.centerY
+        pose = self.cam.pose if self.cam is not None else None
+        if pose is not None and pose.present:
+            camX = pose.x
+            camY = pose.y
         else:
             camX = None
             camY = None
@@ -193,6 +213,13 @@ class TrialThread(Service):
 
         return fly_angle
 
+    def setup(self):
+        self.metricsDumper.start()
+
+    def cleanup(self):
+        # final metrics snapshot for the whole experiment
+        self.metricsDumper.stop()
+
     def loopBody(self):
         if self.stim is not None:
             fly_pos_x, fly_pos_y = self.get_fly_pos()
@@ -200,7 +227,7 @@ class TrialThread(Service):
             self.stim.updateStim(self._trial_dir, fly_pos_x=fly_pos_x, fly_pos_y=fly_pos_y, fly_angle=fly_angle)
 
         if self.state == 'started':
-            if self.cam.flyPresent:
+            if self.cam.pose.present:
                 print('Fly possibly found...')
                 self.timer_start = time()
                 self.state = 'fly detected'
@@ -226,7 +253,7 @@ class TrialThread(Service):
                   self.dispenser.state = 'Idle'
                   print('Dispenser: fly found, going to Idle state.')
 
-            elif not self.cam.flyPresent:
+            elif not self.cam.pose.present:
                 print('Fly lost.')
                 self.timer_start = time()
                 self.prev_state = 'fly detected'
@@ -234,7 +261,7 @@ class TrialThread(Service):
                 self.tracker.stopTracking()
 
         elif self.state == 'run':
-            if not self.cam.flyPresent:
+            if not self.cam.pose.present:
                 print('Fly possibly lost...')
                 self.timer_start = time()
                 self.prev_state = 'run'
@@ -249,7 +276,7 @@ class TrialThread(Service):
                     #self.prev_state = 'fly lost'
                     self.state = 'moving back to center'
         elif self.state == 'fly lost':
-            if self.cam.flyPresent:
+            if self.cam.pose.present:
                 print('Fly located again.')
                 self.timer_start = time()
                 self.tracker.startTracking()
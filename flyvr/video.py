@@ -0,0 +1,439 @@
+import cv2
+import mmap
+import os
+import os.path
+import struct
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
+
+from flyvr.store import read_stream
+
+def index_path(path):
+    # frame index written next to a trial video
+    return os.path.splitext(path)[0] + '_index.bin'
+
+class MjpegWriter:
+    # Writes a motion-JPEG stream (concatenated JPEG images, readable by
+    # ffmpeg and MjpegReader).  Frames are compressed in parallel by a pool
+    # of workers (cv2.imencode releases the GIL) and a single muxer thread
+    # appends them to the file in the order they were submitted.  If given,
+    # on_written(frame, offset, size, meta) is called from the muxer for
+    # every frame that made it into the file, with the meta passed to write().
+    # At most max_pending frames are queued; write() drops (and counts) any
+    # frame beyond that rather than blocking the caller.
+
+    def __init__(self, path, num_workers=4, quality=90, max_pending=32, on_written=None):
+        self.path = path
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self.max_pending = max_pending
+        self.on_written = on_written
+
+        self.file = open(path, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+        # futures in submission order, consumed by the muxer
+        self.cond = Condition()
+        self.pending = deque()
+        self.closing = False
+
+        # statistics
+        self.framesWritten = 0
+        self.bytesWritten = 0
+        self.framesDropped = 0
+
+        self.muxer = Thread(target=self.mux)
+        self.muxer.start()
+
+    def write(self, frame, done=None, meta=None):
+        # done(), if given, is called once the frame buffer is no longer needed;
+        # returns False if the frame was dropped because the queue is full
+        with self.cond:
+            if len(self.pending) >= self.max_pending:
+                self.framesDropped += 1
+                dropped = True
+            else:
+                self.pending.append((self.pool.submit(self.encode, frame, done), meta))
+                self.cond.notify_all()
+                dropped = False
+
+        if dropped:
+            if done is not None:
+                done()
+            return False
+        return True
+
+    def encode(self, frame, done):
+        try:
+            ok, buf = cv2.imencode('.jpg', frame, self.params)
+        finally:
+            if done is not None:
+                done()
+
+        if not ok:
+            raise Exception('JPEG encoding failed.')
+
+        return buf
+
+    def mux(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closing)
+                if not self.pending:
+                    return
+                future, meta = self.pending[0]
+
+            try:
+                buf = future.result()
+            except Exception as e:
+                print('Dropping video frame: {}'.format(e))
+            else:
+                if self.on_written is not None:
+                    self.on_written(self.framesWritten, self.bytesWritten, len(buf), meta)
+                self.file.write(buf.data)
+                self.framesWritten += 1
+                self.bytesWritten += len(buf)
+
+            with self.cond:
+                self.pending.popleft()
+                self.cond.notify_all()
+
+    def release(self):
+        # finish writing every queued frame, then close the file
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+
+        self.muxer.join()
+        self.pool.shutdown()
+        self.file.close()
+
+class VideoIndex:
+    # Frame index of a trial video (the 'video' stream of flyvr.store),
+    # mapping each video frame to its capture time, its camera frame and its
+    # row in the cam stream, and back.
+
+    def __init__(self, path):
+        data = read_stream(path)
+        self.frame = data['frame']
+        self.offset = data['offset']
+        self.size = data['size']
+        self.frame_id = data['frame_id']
+        self.cam_t = data['cam_t']
+        self.host_t = data['host_t']
+        self.pose_row = data['pose_row']
+
+        # video frame of each pose row, for constant-time lookups
+        present = self.pose_row >= 0
+        rows = self.pose_row[present]
+        self.row_frame = np.full(rows.max() + 1 if len(rows) > 0 else 0, -1, dtype=np.int64)
+        self.row_frame[rows] = self.frame[present]
+
+    def __len__(self):
+        return len(self.frame)
+
+    def frame_at(self, t):
+        # last video frame captured at or before host time t, or -1 if the
+        # video has no frames
+        if len(self.frame) == 0:
+            return -1
+        index = np.searchsorted(self.host_t, t, side='right') - 1
+        return int(self.frame[max(index, 0)])
+
+    def frame_of_pose(self, row):
+        # video frame that a cam stream row was detected in, or -1
+        if row < 0 or row >= len(self.row_frame):
+            return -1
+        return int(self.row_frame[row])
+
+    def byte_offsets(self):
+        # start of every frame plus the end of the last one, or None if unknown
+        if len(self.frame) == 0 or self.offset[0] < 0:
+            return None
+        return np.append(self.offset, self.offset[-1] + self.size[-1])
+
+class MjpegReader:
+    # Random access to the frames of a file written by MjpegWriter.  Frame
+    # boundaries come from the frame index if there is one, and are
+    # otherwise found by scanning for JPEG start-of-image markers.
+
+    def __init__(self, path, index=None):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = index
+        offsets = index.byte_offsets() if index is not None else None
+        self.offsets = offsets if offsets is not None else self.scan()
+
+    def scan(self):
+        offsets = []
+        pos = self.data.find(b'\xff\xd8\xff')
+        while pos != -1:
+            offsets.append(pos)
+            end = self.data.find(b'\xff\xd9', pos)
+            if end == -1:
+                break
+            pos = self.data.find(b'\xff\xd8\xff', end + 2)
+        offsets.append(len(self.data))
+        return np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def read(self, index, gray=True):
+        start, stop = self.offsets[index], self.offsets[index+1]
+        buf = np.frombuffer(self.data, dtype=np.uint8, count=stop-start, offset=start)
+        return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read(index)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class CaptureReader:
+    # Same interface as MjpegReader for container files (e.g. cam_compr.mkv)
+    # read through cv2.VideoCapture.  Videos recorded as single-channel
+    # grayscale are still decoded by ffmpeg as BGR, so frames are converted
+    # back to one channel unless color is requested.
+
+    def __init__(self, path, index=None):
+        self.index = index
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise Exception('Could not open video file {}.'.format(path))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.next_index = 0
+
+    def __len__(self):
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def read(self, index, gray=True):
+        # seeking is slow in most containers, so only do it when needed
+        if index != self.next_index:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+        ok, frame = self.cap.read()
+        if not ok:
+            raise IndexError('Could not read frame {}.'.format(index))
+        self.next_index = index + 1
+
+        if gray and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        elif not gray and frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+        return frame
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read(index)
+
+    def close(self):
+        self.cap.release()
+
+# Raw frame store: frames are copied uncompressed into preallocated,
+# memory-mapped segment files <name>-000.raw, <name>-001.raw, ...  Each
+# segment is laid out as
+#     4096 bytes  header: magic b'FLYVRRAW', then uint32 version, height,
+#                 width and capacity (frames), and uint64 count of frames
+#                 written, all little-endian
+#     ...         frame index: capacity records of RAW_INDEX_DTYPE, padded
+#                 to a multiple of 4096 bytes
+#     ...         frames: count (up to capacity) 8-bit height x width images
+# The count is updated after every frame, so a segment stays readable if
+# the program dies, and the unused tail is cut off when the segment is
+# closed.  All segments of a recording have the same capacity.
+
+RAW_MAGIC = b'FLYVRRAW'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('<8sIIIIQ')
+RAW_COUNT = struct.Struct('<Q')
+RAW_COUNT_OFFSET = RAW_HEADER.size - RAW_COUNT.size
+RAW_HEADER_SIZE = 4096
+RAW_INDEX_DTYPE = np.dtype([('frame_id', '<i8'), ('cam_t', '<f8'), ('host_t', '<f8')])
+
+def raw_segment_path(path, segment):
+    return '{}-{:03d}.raw'.format(os.path.splitext(path)[0], segment)
+
+def raw_layout(height, width, capacity):
+    # offsets of the frame index and of the first frame in a segment
+    indexSize = capacity*RAW_INDEX_DTYPE.itemsize
+    indexSize = -(-indexSize//RAW_HEADER_SIZE)*RAW_HEADER_SIZE
+    return RAW_HEADER_SIZE, RAW_HEADER_SIZE + indexSize
+
+class RawSegment:
+    # One preallocated, memory-mapped segment file of a RawWriter.
+
+    def __init__(self, path, height, width, capacity, indexOffset, dataOffset):
+        self.path = path
+        self.dataOffset = dataOffset
+        self.frameSize = height*width
+
+        # allocate the whole segment up front, so that writing never extends the file
+        size = dataOffset + capacity*self.frameSize
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        # have the kernel bring in the pages ahead of time, which roughly
+        # halves the cost of first touching each one in write()
+        if hasattr(self.map, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+            self.map.madvise(mmap.MADV_WILLNEED)
+        RAW_HEADER.pack_into(self.map, 0, RAW_MAGIC, RAW_VERSION, height, width, capacity, 0)
+        self.index = np.ndarray(capacity, dtype=RAW_INDEX_DTYPE, buffer=self.map, offset=indexOffset)
+        self.frames = np.ndarray((capacity, height, width), dtype=np.uint8,
+                                 buffer=self.map, offset=dataOffset)
+        self.count = 0
+
+    def close(self):
+        # views into the map have to go before it can be closed
+        self.index = None
+        self.frames = None
+        self.map.close()
+
+        # write the frames out with fsync, which covers the mapped pages;
+        # unlike mmap.flush() it releases the GIL while it waits for the disk
+        os.fsync(self.file.fileno())
+        self.map = None
+
+        # cut off the unused tail
+        self.file.truncate(self.dataOffset + self.count*self.frameSize)
+        self.file.close()
+
+class RawWriter:
+    # Same interface as MjpegWriter; write() is a copy into the mapped file.
+    # Opening and preallocating a segment, and flushing and closing a full
+    # one, take hundreds of milliseconds for large segments, so both run on
+    # a background thread: the next segment is opened as soon as the
+    # current one is, and write() only swaps them when the current one is full.
+
+    def __init__(self, path, shape, segment_size=1<<30):
+        # shape: (height, width) of the 8-bit frames
+        # segment_size: approximate size of each segment file in bytes
+        self.path = path
+        self.height, self.width = shape
+        self.frameSize = self.height*self.width
+        self.capacity = max(1, segment_size//self.frameSize)
+        self.indexOffset, self.dataOffset = raw_layout(self.height, self.width, self.capacity)
+
+        # opens and closes segments in the order they are asked for
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+        # statistics
+        self.framesWritten = 0
+        self.bytesWritten = 0
+
+        self.segment = 0
+        self.current = self.openSegment(self.segment)
+        self.next = self.worker.submit(self.openSegment, self.segment + 1)
+
+    def openSegment(self, segment):
+        return RawSegment(raw_segment_path(self.path, segment), self.height, self.width,
+                          self.capacity, self.indexOffset, self.dataOffset)
+
+    def closeSegment(self, current):
+        try:
+            current.close()
+        except Exception as e:
+            print('Could not close video segment {}: {}'.format(current.path, e))
+
+    def write(self, frame, done=None, meta=None):
+        # meta: (frame_id, cam_t, host_t, ...) for the frame index
+        current = self.current
+        if current.count == self.capacity:
+            # the next segment is normally ready long before this one is full
+            self.worker.submit(self.closeSegment, current)
+            current = self.current = self.next.result()
+            self.segment += 1
+            self.next = self.worker.submit(self.openSegment, self.segment + 1)
+
+        n = current.count
+        np.copyto(current.frames[n], frame)
+        if meta is not None:
+            current.index[n] = meta[:3]
+        else:
+            current.index[n] = (-1, np.nan, np.nan)
+        current.count = n + 1
+        RAW_COUNT.pack_into(current.map, RAW_COUNT_OFFSET, current.count)
+
+        self.framesWritten += 1
+        self.bytesWritten += self.frameSize
+        if done is not None:
+            done()
+
+    def release(self):
+        # close the current segment and remove the one opened ahead of time
+        self.worker.submit(self.closeSegment, self.current)
+        self.worker.shutdown()
+        self.current = None
+
+        try:
+            unused = self.next.result()
+        except Exception:
+            return
+        self.closeSegment(unused)
+        os.remove(unused.path)
+
+class RawReader:
+    # Zero-copy access to a recording made by RawWriter: every segment is
+    # opened with np.memmap, and frames are views into the files.
+
+    def __init__(self, path, index=None):
+        self.index = index
+        self.frames = []
+        infos = []
+
+        segment = 0
+        while os.path.isfile(raw_segment_path(path, segment)):
+            segPath = raw_segment_path(path, segment)
+            with open(segPath, 'rb') as f:
+                magic, version, height, width, capacity, count = RAW_HEADER.unpack(f.read(RAW_HEADER.size))
+            if magic != RAW_MAGIC:
+                raise Exception('Not a raw frame file: {}.'.format(segPath))
+            indexOffset, dataOffset = raw_layout(height, width, capacity)
+
+            if count > 0:
+                self.frames.append(np.memmap(segPath, dtype=np.uint8, mode='r', offset=dataOffset,
+                                             shape=(count, height, width)))
+                infos.append(np.memmap(segPath, dtype=RAW_INDEX_DTYPE, mode='r', offset=indexOffset,
+                                       shape=(count,)))
+            self.capacity = capacity
+            segment += 1
+
+        # per-frame camera frame id and capture times
+        self.info = np.concatenate(infos) if infos else np.zeros(0, dtype=RAW_INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.info)
+
+    def read(self, index, gray=True):
+        if index < 0 or index >= len(self):
+            raise IndexError('Could not read frame {}.'.format(index))
+        frame = self.frames[index//self.capacity][index % self.capacity]
+        return frame if gray else cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.read(index)
+
+    def close(self):
+        self.frames = []
+
+def open_video(path):
+    # pick a reader based on the recording format, with the frame index if it was saved
+    index = VideoIndex(index_path(path)) if os.path.isfile(index_path(path)) else None
+    if path.endswith('.mjpeg'):
+        return MjpegReader(path, index=index)
+    elif path.endswith('.raw'):
+        return RawReader(path, index=index)
+    else:
+        return CaptureReader(path, index=index)
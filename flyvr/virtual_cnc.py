@@ -0,0 +1,279 @@
+import os
+
+from collections import deque
+from threading import Thread, Lock, Condition, Event
+from time import perf_counter
+
+# Stand-in for the gantry and its Arduino (ArduinoStepper/ArduinoStepper.ino)
+# for testing and benchmarking without hardware.  It speaks the same serial
+# protocol: a 7-byte command (3 bytes per axis, top bit = positive
+# direction, then a checksum of the 6 bytes) is answered by a 6-byte status
+# (limit switch / error flags, X and Y steps as big-endian int16, checksum
+# of the 5 bytes).  Motion follows the firmware: a 30 kHz timer adds the
+# commanded rate to an accumulator and steps whenever it reaches STEP_OVFL,
+# and an axis stops when it runs into the limit switch it is moving toward.
+#
+# Use VirtualStepper.open() as an in-process serial port (pass the stepper
+# as device= to CNC, CncThread, cnc_home or TrackThread), or serve_pty() to
+# expose it on a pseudo-terminal for anything that opens a real port.
+
+STEP_OVFL = 0x7FFFFF
+
+class VirtualStepper:
+    def __init__(self, tick_rate=30000, step_size=25e-6,
+                 start=(0.1, 0.1), travel=((0.0, 0.7), (0.0, 0.66)),
+                 latency=0.5e-3, baud=115200, reset_on_open=True):
+        # start: initial (x, y) position in m, measured from the S / W limits
+        # travel: ((S, N), (W, E)) limit switch positions in m
+        # latency: time the firmware takes to answer a complete command (s)
+        # baud: serial rate, used for the transmission time of each frame
+        # reset_on_open: like the Arduino, restart (and zero the step counters)
+        # whenever the port is opened
+        self.tick_rate = tick_rate
+        self.step_size = step_size
+        self.latency = latency
+        self.byte_time = 10.0/baud
+
+        # limit switch positions, in steps
+        self.limits = [tuple(int(round(v/step_size)) for v in axis) for axis in travel]
+
+        # motor state
+        self.lock = Lock()
+        self.steps = [int(round(start[0]/step_size)), int(round(start[1]/step_size))]
+        self.reset_on_open = reset_on_open
+        self.origin = [0, 0]
+        self.alpha = [0, 0]
+        self.dir = [False, False]
+        self.count = [0, 0]
+        self.lastTime = perf_counter()
+        self.tickFrac = 0.0
+
+        # statistics
+        self.commands = 0
+        self.commErrors = 0
+
+    # kinematics
+
+    def advance(self, now):
+        # run the step timer up to time now
+        elapsed = (now - self.lastTime)*self.tick_rate + self.tickFrac
+        if elapsed <= 0:
+            return
+        ticks = int(elapsed)
+        self.tickFrac = elapsed - ticks
+        self.lastTime = now
+        if ticks == 0:
+            return
+
+        for axis in range(2):
+            low, high = self.limits[axis]
+            positive = self.dir[axis]
+
+            # the timer does nothing for an axis that is pushing into its limit
+            if (positive and self.steps[axis] >= high) or (not positive and self.steps[axis] <= low):
+                continue
+
+            # steps taken over these ticks (at most one per tick)
+            alpha = self.alpha[axis]
+            steps = (self.count[axis] + (ticks - 1)*alpha)//STEP_OVFL
+            self.count[axis] += ticks*alpha - steps*STEP_OVFL
+
+            # stop at the limit switch
+            if positive:
+                steps = min(steps, high - self.steps[axis])
+                self.steps[axis] += steps
+            else:
+                steps = min(steps, self.steps[axis] - low)
+                self.steps[axis] -= steps
+
+    def limit_flags(self):
+        # limit switch bits are pulled low when pressed (N, S, E, W = bits 1-4)
+        (lowX, highX), (lowY, highY) = self.limits
+        flags = 0b00011110
+        if self.steps[0] >= highX:
+            flags &= ~(1 << 1)
+        if self.steps[0] <= lowX:
+            flags &= ~(1 << 2)
+        if self.steps[1] >= highY:
+            flags &= ~(1 << 3)
+        if self.steps[1] <= lowY:
+            flags &= ~(1 << 4)
+        return flags
+
+    @property
+    def position(self):
+        with self.lock:
+            self.advance(perf_counter())
+            return self.steps[0]*self.step_size, self.steps[1]*self.step_size
+
+    # protocol
+
+    def handle(self, cmd, now):
+        # process one 7-byte command at time now and return the status report
+        with self.lock:
+            self.advance(now)
+            flags = self.limit_flags()
+
+            if sum(cmd[0:6]) & 0xff == cmd[6]:
+                for axis in range(2):
+                    b = cmd[3*axis:3*axis+3]
+                    self.dir[axis] = bool((b[0] >> 7) & 1)
+                    self.alpha[axis] = ((b[0] & 0x7f) << 16) | (b[1] << 8) | b[2]
+                self.commands += 1
+            else:
+                flags |= 1
+                self.commErrors += 1
+
+            # positions are counted from where the Arduino last restarted, in 16 bits
+            x = (self.steps[0] - self.origin[0]) & 0xffff
+            y = (self.steps[1] - self.origin[1]) & 0xffff
+
+        out = bytearray([flags, x >> 8, x & 0xff, y >> 8, y & 0xff])
+        out.append(sum(out) & 0xff)
+        return out
+
+    def reset(self):
+        # what happens when the Arduino restarts: motors stop, counters restart
+        with self.lock:
+            self.advance(perf_counter())
+            self.alpha = [0, 0]
+            self.count = [0, 0]
+            self.origin = list(self.steps)
+
+    def open(self):
+        # in-process serial port connected to this stepper
+        if self.reset_on_open:
+            self.reset()
+        return VirtualSerial(self)
+
+    def serve_pty(self):
+        # serve the protocol on a pseudo-terminal; the device is server.path
+        server = PtyServer(self)
+        server.start()
+        return server
+
+class VirtualSerial:
+    # The parts of the serial.Serial interface used by flyvr.cnc.  Written
+    # bytes arrive after their transmission time, complete commands are
+    # answered after the firmware latency, and replies become readable once
+    # they have been transmitted back.
+
+    def __init__(self, stepper):
+        self.stepper = stepper
+        self.timeout = None
+        self.is_open = True
+
+        self.cond = Condition()
+        self.inBuf = bytearray()
+        self.lastArrival = perf_counter()
+        self.lastSent = perf_counter()
+
+        # (time readable, byte) pairs
+        self.outBuf = deque()
+
+        # number of upcoming replies to lose a byte of, for testing resync
+        self.damageReplies = 0
+
+    def write(self, data):
+        now = perf_counter()
+        with self.cond:
+            for byte in data:
+                # bytes are sent back to back
+                self.lastArrival = max(self.lastArrival, now) + self.stepper.byte_time
+                self.inBuf.append(byte)
+                if len(self.inBuf) == 7:
+                    t = self.lastArrival + self.stepper.latency
+                    reply = self.stepper.handle(self.inBuf, t)
+                    self.inBuf = bytearray()
+                    if self.damageReplies > 0:
+                        # line noise ate the first byte
+                        reply = reply[1:]
+                        self.damageReplies -= 1
+                    for b in reply:
+                        self.lastSent = max(self.lastSent, t) + self.stepper.byte_time
+                        self.outBuf.append((self.lastSent, b))
+            self.cond.notify_all()
+        return len(data)
+
+    def ready(self, now):
+        count = 0
+        for t, _ in self.outBuf:
+            if t > now:
+                break
+            count += 1
+        return count
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return self.ready(perf_counter())
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else perf_counter() + self.timeout
+        out = bytearray()
+        with self.cond:
+            while len(out) < size and self.is_open:
+                now = perf_counter()
+                while self.outBuf and self.outBuf[0][0] <= now and len(out) < size:
+                    out.append(self.outBuf.popleft()[1])
+                if len(out) >= size:
+                    break
+
+                # wait for the next byte to be transmitted, or for a write
+                wait = None if deadline is None else deadline - now
+                if wait is not None and wait <= 0:
+                    break
+                if self.outBuf:
+                    nextTime = self.outBuf[0][0] - now
+                    wait = nextTime if wait is None else min(wait, nextTime)
+                self.cond.wait(wait)
+        return bytes(out)
+
+    def damage_reply(self, count=1):
+        # drop the first byte of the next count replies
+        with self.cond:
+            self.damageReplies += count
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+class PtyServer:
+    # serves a VirtualStepper on the master side of a pseudo-terminal
+    def __init__(self, stepper):
+        import tty
+
+        self.stepper = stepper
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.serial = stepper.open()
+        self.done = Event()
+
+    def start(self):
+        self.reader = Thread(target=self.readLoop, daemon=True)
+        self.writer = Thread(target=self.writeLoop, daemon=True)
+        self.reader.start()
+        self.writer.start()
+
+    def readLoop(self):
+        while not self.done.is_set():
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                break
+            self.serial.write(data)
+
+    def writeLoop(self):
+        self.serial.timeout = 0.1
+        while not self.done.is_set():
+            data = self.serial.read(max(self.serial.in_waiting, 1))
+            if data:
+                os.write(self.master, data)
+
+    def stop(self):
+        self.done.set()
+        self.serial.close()
+        os.close(self.master)
+        os.close(self.slave)
@@ -24,9 +24,14 @@ from PyQt5.QtQuick import QQuickView
 
 from flyrpc.launch import launch_server
 from flyvr.service import Service
+from flyvr.metrics import snapshot_all
+from flyvr import sched
+from flyvr.sched import SchedProfile
+from flyvr import logwriter
 
 from flyvr.cnc import CncThread, cnc_home
 from flyvr.camera import CamThread
+from flyvr.camproc import CamProcess
 from flyvr.tracker import TrackThread, ManualVelocity
 from flyvr.dispenser import FlyDispenser
 from flyvr.opto import OptoThread
@@ -46,6 +51,14 @@ class MainGui():
         #self.left = 600
         #self.top = 400
 
+        # Scheduling profiles for the time-critical services.  Real-time
+        # priority and negative nice values need CAP_SYS_NICE and are
+        # skipped (with a message) when it is missing.
+        sched.set_profile('CncThread', SchedProfile(nice=-10, fifo_priority=60))
+        sched.set_profile('TrackThread', SchedProfile(nice=-10, fifo_priority=50))
+        sched.set_profile('CamThread', SchedProfile(nice=-5, gc_policy='freeze'))
+        sched.set_profile('LogWriter', SchedProfile(nice=5))
+
         # Set services to none
         self.dispenser = None
         self.opto = None
@@ -57,6 +70,9 @@ class MainGui():
         self.trial = None
         self.tracker = None
 
+        # run the camera pipeline in its own process
+        self.cam_in_process = False
+
         self.cam_view = None
         self.dispenser_view = None
         self.frameData = None
@@ -222,6 +238,11 @@ class MainGui():
         # Setup fly position plotter
         self.ui.fly_position_plot_button.clicked.connect(lambda x: self.flyPlotter())
 
+        # Service loop metrics window (Ctrl+M)
+        self.metrics_view = None
+        self.metrics_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+M'), self.ui)
+        self.metrics_shortcut.activated.connect(self.metricsViewer)
+
         # Start Temp and Humd Reading
         self.temp = TempMonitor()
         self.temp.start()
@@ -348,6 +369,9 @@ class MainGui():
         genotype = self.ui.genotype_textbox.text()
 
         d = {'user': user, 'age': age, 'timezone': timezone, 'genotype': genotype}
+
+        # scheduling actually in effect for each running service
+        d['scheduling'] = sched.report()
         #add more stuff to metadata
 
         if self.opto is not None:
@@ -575,7 +599,10 @@ class MainGui():
         self.centermarked = True
 
     def camStart(self):
-        self.cam = CamThread()
+        if self.cam_in_process:
+            self.cam = CamProcess()
+        else:
+            self.cam = CamThread()
         self.cam.start()
         self.cam.ma_min = self.ma_min * 1e-3,
         self.cam.ma_max = self.ma_max * 1e-3,
@@ -862,6 +889,9 @@ class MainGui():
         # else:
         self.flypositionwindow = FlyPositionWindow(cam=self.cam, cnc=self.tracker, opto=self.opto)
 
+    def metricsViewer(self):
+        self.metrics_view = MetricsView()
+
     def trialTimer(self):
         self.current_max_inter_fly_wait = self.max_inter_fly_wait
         if self.trial is not None:
@@ -904,6 +934,8 @@ class MainGui():
         # Shutdown extra views
         if self.dispenser_view is not None:
             self.dispenser_view.close()
+        if self.metrics_view is not None:
+            self.metrics_view.close()
 
         # Shutdown services
         if self.tracker is not None:
@@ -922,6 +954,9 @@ class MainGui():
             self.dispenser.stop()
         if self.temp is not None:
             self.temp.stop()
+
+        # write out and close any logs that are still open
+        logwriter.shutdown()
         print('Shutdown Called')
 
     def closed_loop_pos_checked(self):
@@ -1017,7 +1052,13 @@ class CameraView(QWidget):
         except:
             return
 
-        if img is not None:
+        if img is not None and img.ndim == 2:
+            # single-channel frame
+            height, width = img.shape
+            q_img = QtGui.QImage(img.data, width, height, width, QtGui.QImage.Format_Grayscale8)
+            pixmap = QtGui.QPixmap.fromImage(q_img)
+            self.image_label.setPixmap(pixmap)
+        elif img is not None:
             height, width, bytesPerComponent = img.shape
             bytesPerLine = 3 * width
             cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
@@ -1109,6 +1150,56 @@ class DispenserView(QWidget):
         self.timer.stop()
         super().close()
 
+class MetricsView(QWidget):
+    def __init__(self, interval=500):
+        super().__init__()
+        self.title = 'Service Metrics'
+        self.left = 794
+        self.top = 562
+        self.width = 900
+        self.height = 300
+
+        self.columns = ['iters', 'body p50 (ms)', 'body p99 (ms)', 'body max (ms)',
+                        'period p50 (ms)', 'period p99 (ms)', 'period max (ms)', 'slow', 'overruns']
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update_window)
+        self.timer.start(interval)
+
+        self.initUI()
+
+    def initUI(self):
+        self.setWindowTitle(self.title)
+        self.setGeometry(self.left, self.top, self.width, self.height)
+
+        self.table = QtWidgets.QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.main_layout = QtWidgets.QVBoxLayout()
+        self.main_layout.addWidget(self.table)
+        self.setLayout(self.main_layout)
+
+        self.show()
+
+    def update_window(self):
+        snapshot = snapshot_all()
+
+        def ms(value):
+            return '-' if value is None else '{:0.2f}'.format(value*1e3)
+
+        self.table.setRowCount(len(snapshot))
+        self.table.setVerticalHeaderLabels(list(snapshot.keys()))
+        for row, m in enumerate(snapshot.values()):
+            values = [str(m['iterations']),
+                      ms(m['body']['p50']), ms(m['body']['p99']), ms(m['body']['max']),
+                      ms(m['period']['p50']), ms(m['period']['p99']), ms(m['period']['max']),
+                      str(m['slow']), str(m['overruns'])]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QtWidgets.QTableWidgetItem(value))
+
+    def close(self):
+        self.timer.stop()
+        super().close()
+
 class FlyPositionWindow(QWidget):
     def __init__(self, cam, cnc, opto):
         super().__init__()
@@ -1165,9 +1256,10 @@ class FlyPositionWindow(QWidget):
             self.x_plot = self.x_plot[1:]
             self.y_plot = self.y_plot[1:]
 
-        if self.camThread is not None and self.camThread.fly is not None:
-            camX = self.camThread.fly.centerX
-            camY = self.camThread.fly.centerY
+        pose = self.camThread.pose if self.camThread is not None else None
+        if pose is not None and pose.present:
+            camX = pose.x
+            camY = pose.y
         else:
             camX = None
             camY = None
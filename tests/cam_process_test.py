@@ -0,0 +1,24 @@
+from time import sleep
+
+from flyvr.camproc import CamProcess
+from flyvr.source import SyntheticSource
+
+def main(duration=10):
+    # camera pipeline in a separate process, fed by a synthetic fly
+    camProcess = CamProcess(source=SyntheticSource(seed=0))
+    camProcess.start()
+
+    sleep(duration)
+
+    # print out what the parent process received
+    print('pose:', camProcess.pose)
+    print('poses relayed:', camProcess.poseBus.seq)
+    print('display frame:', None if camProcess.drawFrame is None else camProcess.drawFrame.shape)
+    print('frame statistics:', camProcess.frameStats())
+    for name, stats in camProcess.pipelineStats().items():
+        print('{}: {}'.format(name, stats))
+
+    camProcess.stop()
+
+if __name__=='__main__':
+    main()
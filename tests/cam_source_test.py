@@ -0,0 +1,33 @@
+import sys
+
+from time import sleep
+
+from flyvr.camera import CamThread
+from flyvr.source import SyntheticSource, VideoSource
+
+def main(duration=10):
+    # replay a recorded video if one is given, otherwise use a synthetic fly
+    if len(sys.argv) > 1:
+        source = VideoSource(sys.argv[1], realtime=False)
+    else:
+        source = SyntheticSource(realtime=False)
+
+    # launch the camera processing thread
+    camThread = CamThread(source=source)
+    camThread.start()
+
+    sleep(duration)
+
+    # stop processing frames
+    camThread.stop()
+
+    # print out thread information
+    print('frames per second:', 1/camThread.avePeriod)
+    print('number of iterations:', camThread.iterCount)
+    print('search modes:', camThread.cam.searchCounts)
+    print('frame statistics:', camThread.frameStats())
+    for name, stats in camThread.pipelineStats().items():
+        print('{}: {}'.format(name, stats))
+
+if __name__=='__main__':
+    main()
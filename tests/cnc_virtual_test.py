@@ -0,0 +1,125 @@
+import sys
+
+from time import sleep, time
+
+from flyvr import trace
+from flyvr.cnc import AsyncCNC, CncThread, cnc_home
+from flyvr.tracker import TrackThread
+from flyvr.virtual_cnc import VirtualStepper
+
+def run(stepper, transport, velX=0.05, velY=0.03, duration=2):
+    # drive the virtual gantry at a constant velocity and see how far it went
+    cncThread = CncThread(transport=transport, device=stepper)
+    cncThread.start()
+
+    sleep(0.1)
+    startX, startY = stepper.position
+    cncThread.setVel(velX, velY)
+    sleep(duration)
+    cncThread.setVel(0, 0)
+    sleep(0.1)
+    stopX, stopY = stepper.position
+
+    cncThread.stop()
+
+    print('{} transport:'.format(transport))
+    print('  distance: ({:0.4f}, {:0.4f}) m, expected ({:0.4f}, {:0.4f}) m'.format(
+        stopX - startX, stopY - startY, velX*duration, velY*duration))
+    print('  status reports per second:', 1/cncThread.avePeriod)
+    print('  loop body:', cncThread.metrics()['body'])
+    print('  transport:', cncThread.transportStats())
+
+    # within 5% of the commanded distance, allowing for when the commands land
+    assert abs(stopX - startX - velX*duration) < 0.05*velX*duration
+    assert abs(stopY - startY - velY*duration) < 0.05*velY*duration
+    if transport == 'async':
+        stats = cncThread.transportStats()
+        assert stats['timeouts'] == 0
+        assert stats['sync_errors'] == 0
+
+def recenter(stepper, profile):
+    # time a return to the center of the arena through the tracker
+    tracker = TrackThread(cnc_device=stepper, move_profile=profile)
+    tracker.start()
+    sleep(0.2)
+
+    tracker.start_moving_to_center()
+    while tracker.manualPosition is not None:
+        sleep(0.01)
+
+    tracker.start_moving_to_pos(0.05, 0.05)
+    while tracker.manualPosition is not None:
+        sleep(0.01)
+
+    tracker.stop()
+    print('{} move time: {:0.2f} s'.format(profile, tracker.lastMoveTime))
+    assert tracker.lastMoveTime is not None
+
+def send_tagged(cnc, first, count, interval=2e-3):
+    # stream velocity commands, each with its own trace tag
+    for tag in range(first, first + count):
+        cnc.submit(0.01, 0, tag=tag)
+        sleep(interval)
+    sleep(0.05)
+
+def tagged_rtt(first, last, since):
+    # median time from sending each tagged command to its status report
+    events = trace.tracer.snapshot(since=since)
+    sent = {int(e['frame_id']): e['t'] for e in events if e['stage'] == trace.SEND}
+    status = {int(e['frame_id']): e['t'] for e in events if e['stage'] == trace.STATUS}
+    rtt = sorted(status[tag] - sent[tag] for tag in sent if tag in status and first <= tag < last)
+    return rtt[len(rtt)//2]
+
+def resync(stepper):
+    # lose a byte of one reply, and check that the replies after the resync
+    # are still paired with the right commands
+    cnc = AsyncCNC(device=stepper)
+    start = time()
+    send_tagged(cnc, 1000, 100)
+
+    cnc.ser.damage_reply()
+    send_tagged(cnc, 2000, 200)
+    stats = cnc.stats()
+    cnc.close()
+
+    # a reply matched to the wrong command would add a whole command
+    # period to the round trip of every tag after the resync
+    before = tagged_rtt(1000, 1100, start)
+    after = tagged_rtt(2000, 2200, start)
+
+    print('resync after a damaged reply:')
+    print('  sync errors: {}, lost: {}, stale: {}'.format(stats['sync_errors'], stats['lost'], stats['stale']))
+    print('  tagged round trip p50 {:0.2f} ms before, {:0.2f} ms after'.format(1e3*before, 1e3*after))
+    assert stats['sync_errors'] > 0
+    assert stats['lost'] == 1
+    assert stats['stale'] == 0
+    assert after < before + stepper.latency
+
+def main(latency=2e-3):
+    # firmware response latency (s) can be given on the command line
+    if len(sys.argv) > 1:
+        latency = float(sys.argv[1])
+
+    stepper = VirtualStepper(latency=latency)
+
+    # home against the S / W limit switches
+    duration = cnc_home(device=stepper)
+    print('homed in {:0.2f} s at'.format(duration), stepper.position)
+
+    # resting on the S and W switches (bits 2 and 4, pulled low when pressed)
+    flags = stepper.limit_flags()
+    assert not flags & (1 << 2) and not flags & (1 << 4)
+    posX, posY = stepper.position
+    assert abs(posX) < 1e-3 and abs(posY) < 1e-3
+
+    run(stepper, 'sync')
+    run(stepper, 'async')
+    resync(stepper)
+
+    recenter(stepper, 'trapezoid')
+    recenter(stepper, 'scurve')
+
+    print('virtual CNC test passed.')
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+from flyvr.store import StoreWriter, STREAMS
+from flyvr.video import VideoIndex
+
+def write_index(path, rows):
+    writer = StoreWriter(path, STREAMS['video'])
+    for row in rows:
+        writer.append(*row)
+    writer.close()
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'cam_compr_index.bin')
+
+        # a trial that ended before any frame was recorded
+        write_index(path, [])
+        index = VideoIndex(path)
+        print('empty index: {} frames, frame_at(0) = {}, frame_of_pose(0) = {}'.format(
+            len(index), index.frame_at(0), index.frame_of_pose(0)))
+        assert index.frame_at(0) == -1
+        assert index.frame_of_pose(0) == -1
+        assert index.byte_offsets() is None
+
+        # three frames, the middle one without a fly
+        write_index(path, [(0, 0, 100, 10, 0.00, 1.00, 0),
+                           (1, 100, 120, 11, 0.01, 1.01, -1),
+                           (2, 220, 90, 12, 0.02, 1.02, 1)])
+        index = VideoIndex(path)
+        print('frame_at:', [index.frame_at(t) for t in [0.5, 1.0, 1.015, 2.0]])
+        assert [index.frame_at(t) for t in [0.5, 1.0, 1.015, 2.0]] == [0, 0, 1, 2]
+        assert [index.frame_of_pose(row) for row in [0, 1, 2]] == [0, 2, -1]
+        assert list(index.byte_offsets()) == [0, 100, 220, 310]
+
+    print('video index test passed.')
+
+if __name__ == '__main__':
+    main()